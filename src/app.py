@@ -1,14 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, send_from_directory, g, has_request_context, session, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from markupsafe import Markup
 import os
-from datetime import datetime
+import re
+import gzip
+from datetime import datetime, timedelta, timezone
 import time
+import atexit
+import hashlib
+import threading
+import socket
+from collections import Counter
+import click
 #import argparse
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from bson.objectid import ObjectId
+from search import SearchIndex
+from caching import TTLCache, PageCache, MemoryBackend, SqliteBackend
+import mp3
+from covers import CoverStore, IMAGE_ERRORS, detect_format
+from catalog import CatalogReplica, ChangeLog, UNKNOWN
+from blobs import BlobStore, BLOB_NAME_RE
+from jobs import JobQueue
+from metrics import Registry, SqliteStore, RequestStats, MongoCommandListener
 
 #parser = argparse.ArgumentParser()
 #parser.add_argument("--debug", "-d", action="store_true")
@@ -21,10 +39,148 @@ app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ["SECRET_KEY"]
 app.config["UPLOAD_FOLDER"] = "static/uploads"
 app.config["MAX_CONTENT_LENGTH"] = 500 * 1024 ** 2
-
-# MongoDB connection
-mongo_client = MongoClient(f"mongodb+srv://{os.environ.get('MONGODB_USERNAME')}:{os.environ.get('MONGODB_PASSWORD')}@{os.environ.get('MONGODB_CLUSTER')}/?retryWrites=true&w=majority&appName=Cluster0")
-db = mongo_client.fanmade
+app.config["UPLOAD_CHUNK_SIZE"] = 1024 ** 2
+# Unreferenced track and cover files younger than this are never garbage collected
+app.config["BLOB_GC_GRACE_PERIOD"] = float(os.environ.get("BLOB_GC_GRACE_PERIOD", 3600))
+# Play counts are buffered in memory and written in bulk. The interval is the
+# durability window: at most this many seconds of plays are lost on a crash.
+app.config["PLAY_COUNT_FLUSH_INTERVAL"] = float(os.environ.get("PLAY_COUNT_FLUSH_INTERVAL", 5))
+app.config["PLAY_COUNT_FLUSH_THRESHOLD"] = int(os.environ.get("PLAY_COUNT_FLUSH_THRESHOLD", 1000))
+# Track streaming: how long a resolved filename stays authorized without going
+# back to the database, and how long a listener's plays of a track count as one.
+app.config["STREAM_CACHE_TTL"] = float(os.environ.get("STREAM_CACHE_TTL", 60))
+app.config["STREAM_CACHE_SIZE"] = int(os.environ.get("STREAM_CACHE_SIZE", 4096))
+app.config["PLAY_SESSION_TTL"] = float(os.environ.get("PLAY_SESSION_TTL", 300))
+# Albums and users changed through any worker reach the others' in-process state
+# (search index, caches, charts) within this many seconds, see ChangeLog.
+app.config["CATALOG_SYNC_INTERVAL"] = float(os.environ.get("CATALOG_SYNC_INTERVAL", 0.5))
+# Search index: follows the catalog changes, and is also rebuilt from scratch in
+# the background this often. Then the amount of results per page.
+app.config["SEARCH_INDEX_REFRESH"] = float(os.environ.get("SEARCH_INDEX_REFRESH", 3600))
+app.config["SEARCH_RESULTS_LIMIT"] = int(os.environ.get("SEARCH_RESULTS_LIMIT", 50))
+# Logged in users are cached between requests and dropped as soon as a change
+# to them reaches the worker; the TTL only bounds changes made outside the app.
+app.config["SESSION_USER_CACHE_TTL"] = float(os.environ.get("SESSION_USER_CACHE_TTL", 30))
+app.config["SESSION_USER_CACHE_SIZE"] = int(os.environ.get("SESSION_USER_CACHE_SIZE", 10000))
+# Homepage charts are precomputed per worker: recomputed before the next request
+# after a catalog change, and in the background this often for play counts.
+app.config["CHARTS_SIZE"] = int(os.environ.get("CHARTS_SIZE", 4))
+app.config["CHARTS_REFRESH_INTERVAL"] = float(os.environ.get("CHARTS_REFRESH_INTERVAL", 60))
+# Latest releases and featured-on albums kept in each artist's summary
+app.config["ARTIST_SUMMARY_SIZE"] = int(os.environ.get("ARTIST_SUMMARY_SIZE", 4))
+# Play analytics: plays are kept per track, day and hour for RETENTION_DAYS
+# (hourly detail only as long as the trending window needs it). Trending
+# scores count the plays of the window, each halved every HALF_LIFE hours.
+app.config["PLAY_ANALYTICS_RETENTION_DAYS"] = int(os.environ.get("PLAY_ANALYTICS_RETENTION_DAYS", 90))
+app.config["TRENDING_WINDOW_DAYS"] = int(os.environ.get("TRENDING_WINDOW_DAYS", 7))
+app.config["TRENDING_HALF_LIFE_HOURS"] = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 48))
+app.config["TRENDING_REFRESH_INTERVAL"] = float(os.environ.get("TRENDING_REFRESH_INTERVAL", 300))
+app.config["CREDITS_CACHE_TTL"] = float(os.environ.get("CREDITS_CACHE_TTL", 300))
+app.config["CREDITS_CACHE_SIZE"] = int(os.environ.get("CREDITS_CACHE_SIZE", 4096))
+# Hydrated albums are dropped as soon as a catalog change reaches the worker,
+# the TTL only bounds changes made outside the app (e.g. in the shell).
+app.config["ALBUM_CACHE_TTL"] = float(os.environ.get("ALBUM_CACHE_TTL", 300))
+app.config["ALBUM_CACHE_SIZE"] = int(os.environ.get("ALBUM_CACHE_SIZE", 2048))
+app.config["PLAY_MANIFEST_LIMIT"] = int(os.environ.get("PLAY_MANIFEST_LIMIT", 100))
+# Rendered pages for anonymous visitors. The "sqlite" backend is shared by all
+# the workers of a host (so invalidations reach all of them), "memory" is not.
+# Its file lives in the instance folder, not in a world-writable directory.
+app.config["PAGE_CACHE_BACKEND"] = os.environ.get("PAGE_CACHE_BACKEND", "sqlite")
+app.config["PAGE_CACHE_PATH"] = os.environ.get("PAGE_CACHE_PATH", os.path.join(app.instance_path, "page_cache.sqlite3"))
+app.config["PAGE_CACHE_TTL"] = float(os.environ.get("PAGE_CACHE_TTL", 60))
+app.config["PAGE_CACHE_SIZE"] = int(os.environ.get("PAGE_CACHE_SIZE", 10000))
+# Following feed: releases are pushed to the timeline of every follower, except
+# for artists with more than FEED_FANOUT_LIMIT followers whose releases are
+# pulled when the feed is read.
+app.config["FEED_TIMELINE_SIZE"] = int(os.environ.get("FEED_TIMELINE_SIZE", 500))
+app.config["FEED_FANOUT_LIMIT"] = int(os.environ.get("FEED_FANOUT_LIMIT", 10000))
+app.config["FEED_PAGE_SIZE"] = int(os.environ.get("FEED_PAGE_SIZE", 20))
+# Paginated listings (discographies, followers, search results, JSON API):
+# default page size and the largest `limit` an API client can ask for.
+app.config["PAGE_SIZE"] = int(os.environ.get("PAGE_SIZE", 20))
+app.config["PAGE_SIZE_MAX"] = int(os.environ.get("PAGE_SIZE_MAX", 100))
+# Requests issuing more MongoDB commands than this are counted as N+1 suspects
+app.config["N_PLUS_ONE_THRESHOLD"] = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 5))
+# When set, /metrics requires "Authorization: Bearer <token>"
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+# Optional in-process copy of users, albums and tracks (see catalog.py). The
+# poll interval only applies when MongoDB doesn't support change streams.
+app.config["CATALOG_REPLICA"] = os.environ.get("CATALOG_REPLICA", "0") == "1"
+app.config["CATALOG_REPLICA_POLL_INTERVAL"] = float(os.environ.get("CATALOG_REPLICA_POLL_INTERVAL", 60))
+app.config["CATALOG_REPLICA_MAX_TRACKS"] = int(os.environ.get("CATALOG_REPLICA_MAX_TRACKS", 200000))
+# Background jobs (upload post-processing, visibility cascades). "inline" runs
+# them in threads of the web worker, lost if it dies first; "queue" stores them
+# in MongoDB for `flask work-jobs`.
+# A job not finished within the visibility timeout is handed to another worker.
+app.config["JOB_QUEUE_MODE"] = os.environ.get("JOB_QUEUE_MODE", "inline")
+app.config["JOB_VISIBILITY_TIMEOUT"] = float(os.environ.get("JOB_VISIBILITY_TIMEOUT", 300))
+app.config["JOB_MAX_ATTEMPTS"] = int(os.environ.get("JOB_MAX_ATTEMPTS", 5))
+# Metrics are recorded per worker process. The "sqlite" backend sums those of
+# every worker of the host at /metrics (gunicorn scrapes reach any worker);
+# "memory" only shows the worker that answers.
+app.config["METRICS_BACKEND"] = os.environ.get("METRICS_BACKEND", "sqlite")
+app.config["METRICS_PATH"] = os.environ.get("METRICS_PATH", os.path.join(app.instance_path, "metrics.sqlite3"))
+app.config["METRICS_FLUSH_INTERVAL"] = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))
+
+# Instrumentation
+if app.config["METRICS_BACKEND"] == "sqlite":
+    os.makedirs(app.instance_path, exist_ok=True)
+metrics = Registry(
+    SqliteStore(app.config["METRICS_PATH"]) if app.config["METRICS_BACKEND"] == "sqlite" else None,
+    app.config["METRICS_FLUSH_INTERVAL"]
+)
+request_stats = RequestStats()
+route_latency = metrics.histogram("fanmade_request_duration_seconds", "Request latency by route", ("endpoint", "method", "status"))
+route_queries = metrics.histogram("fanmade_request_mongo_commands", "MongoDB commands per request by route", ("endpoint",),
+                                  buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34))
+n_plus_one = metrics.counter("fanmade_n_plus_one_requests_total", "Requests over the N_PLUS_ONE_THRESHOLD command count", ("endpoint",))
+streamed_bytes = metrics.counter("fanmade_streamed_bytes_total", "Audio bytes sent by /tracks/")
+
+# MongoDB connection (MONGODB_URI overrides the Atlas cluster, e.g. for a local mongod)
+app.config["MONGODB_URI"] = os.environ.get("MONGODB_URI") or f"mongodb+srv://{os.environ.get('MONGODB_USERNAME')}:{os.environ.get('MONGODB_PASSWORD')}@{os.environ.get('MONGODB_CLUSTER')}/?retryWrites=true&w=majority&appName=Cluster0"
+app.config["MONGODB_DATABASE"] = os.environ.get("MONGODB_DATABASE", "fanmade")
+# Connections per worker process, and how long to wait before failing a request
+# instead of hanging it on an unreachable cluster
+app.config["MONGODB_MAX_POOL_SIZE"] = int(os.environ.get("MONGODB_MAX_POOL_SIZE", 50))
+app.config["MONGODB_CONNECT_TIMEOUT_MS"] = int(os.environ.get("MONGODB_CONNECT_TIMEOUT_MS", 5000))
+app.config["MONGODB_SERVER_SELECTION_TIMEOUT_MS"] = int(os.environ.get("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000))
+app.config["MONGODB_SOCKET_TIMEOUT_MS"] = int(os.environ.get("MONGODB_SOCKET_TIMEOUT_MS", 20000))
+
+class LazyDatabase:
+    """Stands in for the pymongo Database, connecting on first use in each process.
+
+    Importing the app doesn't touch the network, and a worker forked after
+    import (gunicorn --preload) builds its own MongoClient instead of sharing
+    the parent's sockets and monitor threads.
+    """
+    def __init__(self):
+        self._pid = None
+        self._database = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    client = MongoClient(
+                        app.config["MONGODB_URI"],
+                        maxPoolSize=app.config["MONGODB_MAX_POOL_SIZE"],
+                        connectTimeoutMS=app.config["MONGODB_CONNECT_TIMEOUT_MS"],
+                        serverSelectionTimeoutMS=app.config["MONGODB_SERVER_SELECTION_TIMEOUT_MS"],
+                        socketTimeoutMS=app.config["MONGODB_SOCKET_TIMEOUT_MS"],
+                        event_listeners=[MongoCommandListener(metrics, request_stats)]
+                    )
+                    self._database = client[app.config["MONGODB_DATABASE"]]
+                    self._pid = os.getpid()
+        return self._database
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__(self, name):
+        return self._get()[name]
+
+db = LazyDatabase()
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -68,29 +224,42 @@ class User(UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
     
-    def get_albums(self):
-        return db.albums.find({'user_id': self.id, 'enabled': True})
+    def get_albums(self, cursor=None, limit=20):
+        """A page of the user's albums, newest first, and the cursor of the next one."""
+        return keyset_page(db.albums, {'user_id': self.id, 'enabled': True}, 'created_at', cursor, limit, ALBUM_CARD_PROJECTION)
     
-    def get_followers(self):
-        return db.follows.find({'followed_id': self.id})
+    def get_followers(self, cursor=None, limit=20):
+        return keyset_page(db.follows, {'followed_id': self.id}, '_id', cursor, limit)
     
-    def get_following(self):
-        return db.follows.find({'follower_id': self.id})
+    def get_following(self, cursor=None, limit=20):
+        return keyset_page(db.follows, {'follower_id': self.id}, '_id', cursor, limit)
     
     def save(self):
         if '_id' in self.user_data:
             db.users.update_one({'_id': self.user_data['_id']}, {'$set': self.user_data})
+            session_users.delete(self.id)
         else:
             result = db.users.insert_one(self.user_data)
             self.user_data['_id'] = result.inserted_id
+        catalog_replica.refresh('users', self.user_data['_id'])
         return self
 
+# Fields of the logged in user that are never needed while serving requests
+SESSION_USER_PROJECTION = {'password_hash': 0}
+
 @login_manager.user_loader
 def load_user(user_id):
-    user_data = db.users.find_one({'_id': ObjectId(user_id)})
-    if not user_data:
+    user_data = session_users.get(user_id)
+    if user_data is None:
+        try:
+            user_data = db.users.find_one({'_id': ObjectId(user_id)}, SESSION_USER_PROJECTION) or False
+        except:
+            user_data = False
+        session_users.set(user_id, user_data)
+    # Disabled users are logged out
+    if not user_data or not user_data.get('enabled', True):
         return None
-    return User(user_data)
+    return User(dict(user_data))
 
 #endregion
 
@@ -99,19 +268,133 @@ def load_user(user_id):
 def is_admin(user):
     return not isinstance(user, AnonymousUserMixin) and user.is_admin
 
+session_users = TTLCache(app.config["SESSION_USER_CACHE_SIZE"], app.config["SESSION_USER_CACHE_TTL"])
+
+job_queue = JobQueue(
+    lambda: db.jobs,
+    mode=app.config["JOB_QUEUE_MODE"],
+    visibility_timeout=app.config["JOB_VISIBILITY_TIMEOUT"],
+    max_attempts=app.config["JOB_MAX_ATTEMPTS"]
+)
+
+# When enabled and loaded, the lookups below are answered from memory and only
+# go to MongoDB (through the request loaders) when it returns UNKNOWN.
+catalog_replica = CatalogReplica(
+    lambda: db,
+    poll_interval=app.config["CATALOG_REPLICA_POLL_INTERVAL"],
+    max_tracks=app.config["CATALOG_REPLICA_MAX_TRACKS"],
+    enabled=app.config["CATALOG_REPLICA"]
+)
+
+catalog_changes = ChangeLog(lambda: db.catalog_changes, app.config["CATALOG_SYNC_INTERVAL"])
+
+def forget_session_users(changes):
+    # User.save() only forgets the record in its own worker; this makes a
+    # disabled user logged out everywhere on the next request, not after the TTL
+    if changes is None:
+        session_users.clear()
+        return
+    for change in changes:
+        if change['kind'] == 'user':
+            session_users.delete(change['id'])
+
+catalog_changes.listeners.append(forget_session_users)
+
+@app.before_request
+def sync_catalog():
+    # Before rendering anything (or picking a page cache key) from per-process state
+    if request.endpoint not in ("static", "health", "ready", "metrics_endpoint"):
+        catalog_changes.sync()
+
+class EntityLoader:
+    """Request-scoped batching loader (DataLoader-style) for a single collection.
+
+    Ids are collected with `prime_ids()` and resolved together with a single
+    `$in` query the first time any of them is needed. Every document fetched
+    is memoized for the rest of the request, including misses.
+    """
+    def __init__(self, collection, wrap=None, projection=None):
+        self.collection = collection
+        self.wrap = wrap
+        self.projection = projection
+        self.cache = {}
+        self.pending = set()
+
+    def prime_ids(self, ids):
+        for entity_id in ids:
+            entity_id = str(entity_id)
+            if entity_id not in self.cache:
+                self.pending.add(entity_id)
+
+    def prime(self, document):
+        self.cache[str(document['_id'])] = self.wrap(document) if self.wrap else document
+
+    def dispatch(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, set()
+
+        object_ids = []
+        for entity_id in pending:
+            self.cache[entity_id] = None
+            try:
+                object_ids.append(ObjectId(entity_id))
+            except:
+                pass
+
+        if object_ids:
+            for document in self.collection.find({'_id': {'$in': object_ids}}, self.projection):
+                self.prime(document)
+
+    def load_many(self, ids):
+        ids = [str(entity_id) for entity_id in ids]
+        self.prime_ids(ids)
+        self.dispatch()
+        return {entity_id: self.cache[entity_id] for entity_id in ids if self.cache[entity_id] is not None}
+
+    def load(self, entity_id):
+        return self.load_many([entity_id]).get(str(entity_id))
+
+class Loaders:
+    def __init__(self):
+        # Only login reads password hashes, and it doesn't go through the loaders
+        self.users = EntityLoader(db.users, wrap=User, projection=SESSION_USER_PROJECTION)
+        self.albums = EntityLoader(db.albums)
+        self.tracks = EntityLoader(db.tracks)
+
+def get_loaders():
+    if 'loaders' not in g:
+        g.loaders = Loaders()
+    return g.loaders
+
 def get_album_by_id(album_id):
+    album = catalog_replica.get('albums', album_id)
+    if album is not UNKNOWN:
+        return album
+    if has_request_context():
+        return get_loaders().albums.load(album_id)
     try:
         return db.albums.find_one({'_id': ObjectId(album_id)})
     except:
         return None
 
 def get_track_by_id(track_id):
+    track = catalog_replica.get('tracks', track_id)
+    if track is not UNKNOWN:
+        return track
+    if has_request_context():
+        return get_loaders().tracks.load(track_id)
     try:
         return db.tracks.find_one({'_id': ObjectId(track_id)})
     except:
         return None
 
 def get_user_by_id(user_id):
+    user_data = catalog_replica.get('users', user_id)
+    if user_data is not UNKNOWN:
+        return User(user_data) if user_data else None
+    if has_request_context():
+        return get_loaders().users.load(user_id)
     try:
         user_data = db.users.find_one({'_id': ObjectId(user_id)})
         if user_data:
@@ -121,91 +404,1259 @@ def get_user_by_id(user_id):
         return None
 
 def get_user_by_username(username):
-    user_data = db.users.find_one({'username': username.lower()})
+    user_data = catalog_replica.user_by('username', username.lower())
+    if user_data is UNKNOWN:
+        user_data = db.users.find_one({'username': username.lower()})
     if user_data:
         return User(user_data)
     return None
 
 def get_user_by_artist_name(artist_name):
-    user_data = db.users.find_one({'artistName': artist_name})
+    user_data = catalog_replica.user_by('artistName', artist_name)
+    if user_data is UNKNOWN:
+        user_data = db.users.find_one({'artistName': artist_name})
     if user_data:
         return User(user_data)
     return None
 
+# Pagination
+
+# Fields read by the views listing albums, tracks and users
+ALBUM_CARD_PROJECTION = {'title': 1, 'cover_image': 1, 'explicit': 1, 'created_at': 1, 'user_id': 1, 'enabled': 1}
+TRACK_ROW_PROJECTION = {'title': 1, 'album_id': 1, 'explicit': 1, 'played': 1, 'duration': 1, 'enabled': 1}
+USER_CARD_PROJECTION = {'artistName': 1, 'username': 1, 'enabled': 1}
+
+def encode_cursor(value, entity_id):
+    if isinstance(value, datetime):
+        value = int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    return f"{value}-{entity_id}"
+
+def decode_cursor(cursor, kind):
+    """Inverse of encode_cursor, `kind` being the type of the sort value. Aborts on a malformed cursor."""
+    try:
+        value, entity_id = cursor.rsplit("-", 1)
+        if kind is datetime:
+            return datetime.utcfromtimestamp(int(value) / 1000), entity_id
+        return kind(value), entity_id
+    except ValueError:
+        abort(400)
+
+def page_limit(default=None):
+    """The `limit` query argument, bounded by PAGE_SIZE_MAX."""
+    limit = request.args.get('limit', type=int) or default or app.config["PAGE_SIZE"]
+    return max(1, min(limit, app.config["PAGE_SIZE_MAX"]))
+
+def keyset_page(collection, query, sort_field, cursor=None, limit=20, projection=None, kind=datetime):
+    """One page of `collection` sorted by (sort_field, _id) descending, and the cursor of the next page.
+
+    Resumes after the last document of the previous page instead of skipping
+    over it, so with a matching compound index every page costs the same.
+    `sort_field` can be '_id' itself, the cursor is then just the id.
+    """
+    query = dict(query)
+    if cursor:
+        if sort_field == '_id':
+            value, entity_id = None, cursor
+        else:
+            value, entity_id = decode_cursor(cursor, kind)
+        try:
+            entity_id = ObjectId(entity_id)
+        except:
+            abort(400)
+        if sort_field == '_id':
+            query['_id'] = {'$lt': entity_id}
+        else:
+            # The top-level bound lets the index scan start at the cursor
+            query[sort_field] = {'$lte': value}
+            query['$or'] = [{sort_field: {'$lt': value}}, {'_id': {'$lt': entity_id}}]
+
+    sort = [('_id', -1)] if sort_field == '_id' else [(sort_field, -1), ('_id', -1)]
+    documents = list(collection.find(query, projection).sort(sort).limit(limit + 1))
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        next_cursor = str(last['_id']) if sort_field == '_id' else encode_cursor(last.get(sort_field), last['_id'])
+    return documents, next_cursor
+
+def album_track_ids(album_ids):
+    """Track ids of each album, with one query."""
+    album_tracks = {}
+    for track in db.tracks.find({'album_id': {'$in': [str(album_id) for album_id in album_ids]}}, {'album_id': 1}):
+        album_tracks.setdefault(track['album_id'], []).append(str(track['_id']))
+    return album_tracks
+
+# Play counter
+
+class PlayCounter:
+    """Write-behind buffer for track play counts.
+
+    Plays are accumulated per track id and written with a single `bulk_write`
+    every `interval` seconds, as soon as `threshold` plays are pending, and
+    when the worker exits. The flusher thread is started lazily so that it
+    belongs to the process that actually serves requests.
+    """
+    def __init__(self, interval, threshold):
+        self.interval = interval
+        self.threshold = threshold
+        self.counts = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.listeners = []
+        self.pid = None
+
+    def add(self, track_id, amount=1):
+        with self.lock:
+            self.counts[track_id] = self.counts.get(track_id, 0) + amount
+            self.pending += amount
+            full = self.pending >= self.threshold
+        self.ensure_started()
+        if full:
+            self.wakeup.set()
+
+    def ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name="play-counter", daemon=True).start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Error flushing play counts")
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            self.pending = 0
+        if not counts:
+            return
+
+        try:
+            db.tracks.bulk_write(
+                [UpdateOne({'_id': track_id}, {'$inc': {'played': amount}}) for track_id, amount in counts.items()],
+                ordered=False
+            )
+        except:
+            # Put the counts back so they are retried on the next flush
+            with self.lock:
+                for track_id, amount in counts.items():
+                    self.counts[track_id] = self.counts.get(track_id, 0) + amount
+                    self.pending += amount
+            raise
+
+        # The counts are written, one failing listener mustn't cost the others theirs
+        for listener in self.listeners:
+            try:
+                listener(counts)
+            except Exception:
+                app.logger.exception("Error handling flushed play counts in %s", getattr(listener, '__qualname__', listener))
+
+play_counter = PlayCounter(app.config["PLAY_COUNT_FLUSH_INTERVAL"], app.config["PLAY_COUNT_FLUSH_THRESHOLD"])
+
+# Play analytics
+
+class PlayAnalytics:
+    """Plays bucketed per track and UTC day in `play_buckets`, and trending charts.
+
+    A bucket is `{_id: "<track id>:<YYYYMMDD>", day, track_id, album_id,
+    user_id, total, hours: {"<hour>": plays}}`. Each play counter flush
+    becomes one upsert per track played, never a write per play. Buckets
+    expire after `retention_days` (TTL index) and lose their hourly detail
+    once they are out of the trending window.
+
+    Trending results are precomputed in `trending` at most every
+    `refresh_interval` seconds by whichever worker flushes first: the global
+    top tracks under `_id: 'global'`, and per artist (keyed by user id) the
+    plays of the window and their top tracks.
+    """
+    def __init__(self, window_days, half_life_hours, refresh_interval, size):
+        self.window_days = window_days
+        self.half_life_hours = half_life_hours
+        self.refresh_interval = refresh_interval
+        self.size = size
+
+    def on_plays(self, counts):
+        now = datetime.utcnow()
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        tracks = db.tracks.find({'_id': {'$in': list(counts)}}, {'album_id': 1})
+        albums = EntityLoader(db.albums)
+        tracks = {track['_id']: track['album_id'] for track in tracks}
+        albums.load_many(tracks.values())
+
+        updates = []
+        for track_id, amount in counts.items():
+            album = albums.load(tracks[track_id]) if track_id in tracks else None
+            if not album:
+                continue
+            updates.append(UpdateOne(
+                {'_id': f"{track_id}:{day:%Y%m%d}"},
+                {
+                    '$inc': {'total': amount, f'hours.{now.hour}': amount},
+                    '$setOnInsert': {'day': day, 'track_id': str(track_id), 'album_id': str(album['_id']), 'user_id': album['user_id']}
+                },
+                upsert=True
+            ))
+        if updates:
+            db.play_buckets.bulk_write(updates, ordered=False)
+        self.refresh_if_stale()
+
+    def refresh_if_stale(self):
+        now = datetime.utcnow()
+        stale = datetime.utcfromtimestamp(time.time() - self.refresh_interval)
+        try:
+            # Claims the refresh, so only one worker recomputes per interval
+            db.trending.find_one_and_update(
+                {'_id': 'global', 'computed_at': {'$lt': stale}},
+                {'$set': {'computed_at': now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Fresh enough, or another worker is on it
+            return
+        threading.Thread(target=self.background_refresh, args=(now,), name="trending", daemon=True).start()
+
+    def background_refresh(self, now):
+        try:
+            self.refresh(now)
+            homepage_charts.invalidate()
+        except Exception:
+            app.logger.exception("Error refreshing trending charts")
+
+    def window_start(self, now):
+        return now - timedelta(days=self.window_days)
+
+    def scores(self, now):
+        """Plays and decayed score of every track played in the window, best first."""
+        start = self.window_start(now)
+        return db.play_buckets.aggregate([
+            {'$match': {'day': {'$gte': start - timedelta(days=1)}}},
+            {'$project': {'track_id': 1, 'album_id': 1, 'user_id': 1, 'day': 1, 'hours': {'$objectToArray': '$hours'}}},
+            {'$unwind': '$hours'},
+            {'$project': {
+                'track_id': 1, 'album_id': 1, 'user_id': 1, 'plays': '$hours.v',
+                'at': {'$add': ['$day', {'$multiply': [{'$toInt': '$hours.k'}, 3600 * 1000]}]}
+            }},
+            {'$match': {'at': {'$gte': start}}},
+            {'$group': {
+                '_id': '$track_id',
+                'album_id': {'$first': '$album_id'},
+                'user_id': {'$first': '$user_id'},
+                'plays': {'$sum': '$plays'},
+                'score': {'$sum': {'$multiply': ['$plays', {'$pow': [0.5, {'$divide': [
+                    {'$subtract': [now, '$at']}, self.half_life_hours * 3600 * 1000
+                ]}]}]}}
+            }},
+            {'$sort': {'score': -1, '_id': -1}}
+        ], allowDiskUse=True)
+
+    def refresh(self, now=None):
+        now = now or datetime.utcnow()
+        top = []
+        artists = {}
+        for result in self.scores(now):
+            entry = {'track_id': result['_id'], 'album_id': result['album_id'], 'plays': result['plays'], 'score': result['score']}
+            # Extra candidates, some may be disabled when the charts are read
+            if len(top) < self.size * 4:
+                top.append(entry)
+            artist = artists.setdefault(result['user_id'], {'plays': 0, 'tracks': []})
+            artist['plays'] += result['plays']
+            if len(artist['tracks']) < self.size * 2:
+                artist['tracks'].append(entry)
+
+        updates = [UpdateOne({'_id': 'global'}, {'$set': {'tracks': top, 'computed_at': now}}, upsert=True)]
+        for user_id, artist in artists.items():
+            updates.append(UpdateOne(
+                {'_id': user_id},
+                {'$set': {'window_plays': artist['plays'], 'tracks': artist['tracks'], 'computed_at': now}},
+                upsert=True
+            ))
+        db.trending.bulk_write(updates, ordered=False)
+        # Artists nobody played during the window
+        db.trending.delete_many({'_id': {'$ne': 'global'}, 'computed_at': {'$lt': now}})
+
+        # Compaction: hourly detail is only read inside the window
+        db.play_buckets.update_many(
+            {'day': {'$lt': self.window_start(now) - timedelta(days=1)}, 'hours': {'$exists': True}},
+            {'$unset': {'hours': ""}}
+        )
+
+    def top_tracks(self):
+        trending = db.trending.find_one({'_id': 'global'})
+        return trending.get('tracks', []) if trending else []
+
+    def artist(self, user_id):
+        """Plays of the window and trending tracks of an artist, with their albums."""
+        trending = db.trending.find_one({'_id': user_id}) or {'window_plays': 0, 'tracks': []}
+        loaders = get_loaders()
+        tracks = loaders.tracks.load_many(entry['track_id'] for entry in trending['tracks'])
+        albums = loaders.albums.load_many(entry['album_id'] for entry in trending['tracks'])
+
+        entries = []
+        for entry in trending['tracks']:
+            track = tracks.get(entry['track_id'])
+            album = albums.get(entry['album_id'])
+            if track and album and track.get('visible'):
+                entries.append(dict(artist_summaries.track_summary(track, album), window_plays=entry['plays']))
+        return trending['window_plays'], entries[:self.size]
+
+play_analytics = PlayAnalytics(app.config["TRENDING_WINDOW_DAYS"], app.config["TRENDING_HALF_LIFE_HOURS"],
+                               app.config["TRENDING_REFRESH_INTERVAL"], app.config["CHARTS_SIZE"])
+play_counter.listeners.append(play_analytics.on_plays)
+
+# Search
+
+class CatalogSearch:
+    """Keeps the in-process `SearchIndex` of albums in sync with the catalog.
+
+    The index is built in a background thread, searches go to MongoDB until
+    it is ready. It then follows `catalog_changes`, re-indexing each album
+    uploaded or toggled through any worker. A full rebuild only happens every
+    `refresh_interval`, or when this worker fell behind the change log.
+    """
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.index = None
+        self.built_at = 0
+        self.lock = threading.Lock()
+        self.rebuilding = False
+        # Changes applied during a rebuild, applied again to the new index
+        self.pending = []
+
+    def ensure(self):
+        """Start a (re)build if due. Returns the index, None until the first build is done."""
+        if self.index is None or time.monotonic() - self.built_at > self.refresh_interval:
+            with self.lock:
+                if not self.rebuilding:
+                    self.rebuilding = True
+                    threading.Thread(target=self.rebuild, name="search-index", daemon=True).start()
+        return self.index
+
+    def rebuild(self):
+        try:
+            index = self.build()
+            with self.lock:
+                self.index = index
+                self.built_at = time.monotonic()
+                pending, self.pending = self.pending, []
+                self.rebuilding = False
+            self.apply(pending)
+        except Exception:
+            app.logger.exception("Error rebuilding search index")
+        finally:
+            self.rebuilding = False
+
+    def build(self):
+        index = SearchIndex()
+        users = {str(user['_id']): User(user) for user in db.users.find({}, {'password_hash': 0})}
+
+        tracks_by_album = {}
+        album_by_track = {}
+        for track in db.tracks.find({}, {'title': 1, 'album_id': 1, 'featuring': 1}):
+            tracks_by_album.setdefault(track['album_id'], []).append(track)
+            album_by_track[str(track['_id'])] = track['album_id']
+
+        credits_by_album = {}
+        for credit in db.credits.find({}, {'track_id': 1, 'name': 1}):
+            album_id = album_by_track.get(credit['track_id'])
+            if album_id:
+                credits_by_album.setdefault(album_id, []).append(credit)
+
+        for album in db.albums.find():
+            owner = users.get(album['user_id'])
+            if owner:
+                album_id = str(album['_id'])
+                self.add(index, album, owner, tracks_by_album.get(album_id, []), credits_by_album.get(album_id, []), users)
+        return index
+
+    def meta(self, album, owner):
+        return {
+            'title': album['title'],
+            'artist_name': owner.artistName,
+            'username': owner.username,
+            'user_id': owner.id,
+            'cover_image': album.get('cover_image'),
+            'enabled': album.get('enabled', True),
+            'user_enabled': owner.enabled
+        }
+
+    def add(self, index, album, owner, tracks, credits, users):
+        featuring = [users[user_id].artistName for track in tracks for user_id in track.get('featuring', []) if user_id in users]
+        index.add(
+            str(album['_id']),
+            {
+                'title': [album['title']],
+                'artist': [owner.artistName],
+                'username': [owner.username],
+                'track': [track['title'] for track in tracks],
+                'featuring': featuring,
+                'credit': [credit['name'] for credit in credits]
+            },
+            **self.meta(album, owner)
+        )
+
+    def on_changes(self, changes):
+        if changes is None:
+            # Fell behind the change log
+            self.built_at = 0
+            self.ensure()
+            return
+        with self.lock:
+            if self.rebuilding:
+                self.pending.extend(changes)
+        self.apply(changes)
+
+    def apply(self, changes):
+        index = self.index
+        if index is None:
+            return
+        for kind, entity_id in dict.fromkeys((change['kind'], change['id']) for change in changes):
+            if kind == 'album':
+                self.reindex_album(index, entity_id)
+            elif kind == 'user':
+                user = db.users.find_one({'_id': ObjectId(entity_id)}, {'enabled': 1})
+                if user:
+                    index.update_where(lambda meta: meta['user_id'] == entity_id, user_enabled=user.get('enabled', True))
+
+    def reindex_album(self, index, album_id):
+        album = db.albums.find_one({'_id': ObjectId(album_id)})
+        owner = album and db.users.find_one({'_id': ObjectId(album['user_id'])}, SESSION_USER_PROJECTION)
+        if not owner:
+            index.remove(album_id)
+            return
+        tracks = list(db.tracks.find({'album_id': album_id}, {'title': 1, 'featuring': 1}))
+        credits = list(db.credits.find({'track_id': {'$in': [str(track['_id']) for track in tracks]}}, {'name': 1}))
+        users = EntityLoader(db.users, wrap=User, projection=USER_CARD_PROJECTION).load_many(
+            user_id for track in tracks for user_id in track.get('featuring', [])
+        )
+        self.add(index, album, User(owner), tracks, credits, users)
+
+    def fallback(self, query, admin, after, limit):
+        """Albums whose title or artist contains `query`, straight from MongoDB (unindexed)."""
+        pattern = {'$regex': re.escape(query.strip()), '$options': 'i'}
+        owners = EntityLoader(db.users, wrap=User, projection=USER_CARD_PROJECTION)
+        for user in db.users.find({'$or': [{'artistName': pattern}, {'username': pattern}]}, USER_CARD_PROJECTION).limit(limit):
+            owners.prime(user)
+
+        filters = {'$or': [{'title': pattern}, {'user_id': {'$in': list(owners.cache)}}]}
+        if not admin:
+            filters['enabled'] = {'$ne': False}
+        if after:
+            filters['_id'] = {'$lt': ObjectId(after[1])}
+        albums = list(db.albums.find(filters, ALBUM_CARD_PROJECTION).sort('_id', -1).limit(limit))
+        owners.load_many(album['user_id'] for album in albums)
+
+        results = []
+        for album in albums:
+            owner = owners.load(album['user_id'])
+            if owner and (admin or owner.enabled):
+                results.append((0.0, str(album['_id']), self.meta(album, owner)))
+        return results
+
+    def search(self, query, admin=False, after=None, limit=None):
+        limit = limit or app.config["SEARCH_RESULTS_LIMIT"]
+        index = self.ensure()
+        if index is None:
+            return self.fallback(query, admin, after, limit)
+        predicate = None if admin else (lambda meta: meta['enabled'] and meta['user_enabled'])
+        return index.search(query, limit=limit, predicate=predicate, after=after)
+
+catalog_search = CatalogSearch(app.config["SEARCH_INDEX_REFRESH"])
+catalog_changes.listeners.append(catalog_search.on_changes)
+
+# Charts
+
+class HomepageCharts:
+    """Precomputed, pre-joined homepage charts.
+
+    Keeps an in-memory snapshot of the latest releases, the most played tracks
+    and the latest releases per primary genre, for both admins (who also see
+    disabled content) and everyone else. Requests only read the snapshot. It
+    is recomputed in the background after play count flushes and every
+    `refresh_interval`, and before it is read again after a catalog change
+    (uploads, enable/disable actions) so no page renders it outdated.
+    """
+    def __init__(self, size, refresh_interval):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self.snapshots = None
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+        # Set by catalog changes, cleared when a refresh starts
+        self.stale = False
+
+    def snapshot(self, admin=False):
+        if self.snapshots is None or self.stale:
+            with self.lock:
+                if self.snapshots is None or self.stale:
+                    self.refresh()
+        elif time.monotonic() - self.refreshed_at > self.refresh_interval:
+            self.invalidate()
+        return self.snapshots['admin' if admin else 'public']
+
+    def invalidate(self):
+        """Recompute the charts in the background."""
+        if self.snapshots is None or self.refreshing:
+            return
+        self.refreshing = True
+        threading.Thread(target=self.background_refresh, name="charts", daemon=True).start()
+
+    def background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            app.logger.exception("Error refreshing charts")
+        finally:
+            self.refreshing = False
+
+    def refresh(self):
+        self.stale = False
+        # Fetch a few extra candidates, some are dropped when their artist is disabled
+        pool = self.size * 4
+        latest = list(db.albums.find().sort('created_at', -1).limit(pool * 8))
+        played = list(db.tracks.find({'played': {'$gt': 0}}).sort('played', -1).limit(pool))
+        trending = play_analytics.top_tracks()
+
+        albums = EntityLoader(db.albums)
+        users = EntityLoader(db.users, wrap=User)
+        tracks = EntityLoader(db.tracks)
+        for album in latest:
+            albums.prime(album)
+        for track in played:
+            tracks.prime(track)
+        tracks.load_many(entry['track_id'] for entry in trending)
+        albums.load_many(track['album_id'] for track in tracks.cache.values() if track)
+        users.load_many(album['user_id'] for album in albums.cache.values() if album)
+
+        # Track ids per album, so templates can tell singles from albums
+        album_tracks = {}
+        for track in db.tracks.find({'album_id': {'$in': [str(album['_id']) for album in latest]}}, {'album_id': 1}):
+            album_tracks.setdefault(track['album_id'], []).append(str(track['_id']))
+
+        snapshots = {'admin': self.empty(), 'public': self.empty()}
+        for album in latest:
+            user = users.load(album['user_id'])
+            if user:
+                self.add_release(snapshots, self.release_entry(album, user, album_tracks.get(str(album['_id']), [])))
+
+        self.add_tracks(snapshots, 'most_played', played, albums, users)
+        self.add_tracks(snapshots, 'trending', [tracks.load(entry['track_id']) for entry in trending], albums, users)
+
+        self.snapshots = snapshots
+        self.refreshed_at = time.monotonic()
+
+    def add_tracks(self, snapshots, chart, tracks, albums, users):
+        for track in tracks:
+            album = track and albums.load(track['album_id'])
+            user = album and users.load(album['user_id'])
+            if user:
+                track = dict(track, id=str(track['_id']), album=album)
+                enabled = track.get('enabled', True) and album.get('enabled', True) and user.enabled
+                for key in self.variants(enabled):
+                    if len(snapshots[key][chart]) < self.size:
+                        snapshots[key][chart].append((track, user, enabled))
+
+    def empty(self):
+        return {'latest_releases': [], 'most_played': [], 'trending': [], 'genres': {}}
+
+    def variants(self, enabled):
+        return ('admin', 'public') if enabled else ('admin',)
+
+    def release_entry(self, album, user, track_ids):
+        album = dict(album, id=str(album['_id']), tracks=track_ids)
+        return (album, user, album.get('enabled', True) and user.enabled)
+
+    def add_release(self, snapshots, entry):
+        album, user, enabled = entry
+        for key in self.variants(enabled):
+            charts = [snapshots[key]['latest_releases']]
+            if album.get('primary_genre'):
+                charts.append(snapshots[key]['genres'].setdefault(album['primary_genre'], []))
+            for chart in charts:
+                if len(chart) < self.size:
+                    chart.append(entry)
+
+    def on_plays(self, counts):
+        self.invalidate()
+
+    def on_changes(self, changes):
+        self.stale = True
+
+homepage_charts = HomepageCharts(app.config["CHARTS_SIZE"], app.config["CHARTS_REFRESH_INTERVAL"])
+play_counter.listeners.append(homepage_charts.on_plays)
+catalog_changes.listeners.append(homepage_charts.on_changes)
+
+# Albums
+
+album_cache = TTLCache(app.config["ALBUM_CACHE_SIZE"], app.config["ALBUM_CACHE_TTL"])
+
+def hydrate_album(album_id):
+    """Load an album with its owner and ordered tracks, featuring artists resolved.
+
+    Costs one query per collection (albums, tracks, users) whatever the number
+    of tracks, and the result is cached until the album or its artists change
+    (through any worker, see `catalog_changes`).
+    """
+    album_id = str(album_id)
+    album = album_cache.get(album_id)
+    if album is not None:
+        return album or None
+
+    # Not cached if a change arrives while loading, it may predate it
+    version = catalog_changes.version
+    album = get_album_by_id(album_id)
+    if not album:
+        if catalog_changes.version == version:
+            album_cache.set(album_id, False)
+        return None
+
+    tracks = catalog_replica.album_tracks(album_id)
+    if tracks is UNKNOWN:
+        tracks = list(db.tracks.find({'album_id': album_id}).sort('_id', 1))
+    users = get_loaders().users.load_many(
+        [album['user_id']] + [user_id for track in tracks for user_id in track.get('featuring', [])]
+    )
+
+    album = dict(album, id=album_id, user=users.get(album['user_id']), tracks=[
+        dict(track, id=str(track['_id']), featuring=[users[user_id] for user_id in track.get('featuring', []) if user_id in users])
+        for track in tracks
+    ])
+    if catalog_changes.version == version:
+        album_cache.set(album_id, album)
+    return album
+
+def forget_albums(changes):
+    if changes is None or any(change['kind'] == 'user' for change in changes):
+        # An artist appears on albums of others, don't bother finding which
+        album_cache.clear()
+        return
+    for change in changes:
+        album_cache.delete(change['id'])
+
+catalog_changes.listeners.append(forget_albums)
+
+def visible_tracks(album, admin=False):
+    """Copy of a hydrated album without its disabled tracks, unless for an admin."""
+    if admin:
+        return album
+    return dict(album, tracks=[track for track in album['tracks'] if track.get('enabled', True)])
+
+# Track visibility
+#
+# Tracks carry their effective visibility (their own, their album's and their
+# owner's `enabled` flags combined) and summaries of their owner and album, so
+# streaming and the playback API decide on and describe a track with one read.
+# Toggling an album or a user cascades to its tracks in a background job, which
+# records the change again once done so every worker drops its stream cache.
+
+ALBUM_SUMMARY_PROJECTION = {'title': 1, 'cover_image': 1, 'enabled': 1, 'user_id': 1}
+
+def track_summaries(album, owner):
+    return {
+        'owner': {'id': owner.id, 'artistName': owner.artistName, 'username': owner.username},
+        'album_summary': {'title': album['title'], 'cover_image': album.get('cover_image')}
+    }
+
+def visibility_update(album, owner):
+    """Update pipeline setting the denormalized fields of the tracks of `album`."""
+    summaries = track_summaries(album, owner)
+    return [{'$set': {
+        # Literals, so a title starting with "$" isn't read as a field path
+        'owner': {'$literal': summaries['owner']},
+        'album_summary': {'$literal': summaries['album_summary']},
+        'visible': {'$and': [album.get('enabled', True) and owner.enabled, {'$ne': ['$enabled', False]}]}
+    }}]
+
+def cascade_visibility(query):
+    """Recompute the denormalized fields of the tracks of the albums matching `query`."""
+    owners = EntityLoader(db.users, wrap=User, projection=USER_CARD_PROJECTION)
+    batch = []
+
+    def write(batch):
+        owners.load_many(album['user_id'] for album in batch)
+        updates = [
+            UpdateMany({'album_id': str(album['_id'])}, visibility_update(album, owners.load(album['user_id'])))
+            for album in batch if owners.load(album['user_id'])
+        ]
+        if updates:
+            db.tracks.bulk_write(updates, ordered=False)
+
+    for album in db.albums.find(query, ALBUM_SUMMARY_PROJECTION):
+        batch.append(album)
+        if len(batch) == 1000:
+            write(batch)
+            batch = []
+    if batch:
+        write(batch)
+
+@job_queue.handler("cascade_visibility")
+def cascade_visibility_job(payload):
+    if 'album_id' in payload:
+        cascade_visibility({'_id': ObjectId(payload['album_id'])})
+        catalog_changes.record('album', payload['album_id'])
+    else:
+        cascade_visibility({'user_id': payload['user_id']})
+        catalog_changes.record('user', payload['user_id'])
+
+def stale_visibility_albums():
+    """Ids of the albums with a track whose denormalized fields disagree with its album and owner."""
+    pipeline = [
+        {'$project': ALBUM_SUMMARY_PROJECTION},
+        {'$lookup': {
+            'from': 'users',
+            'let': {'user_oid': {'$toObjectId': '$user_id'}},
+            'pipeline': [{'$match': {'$expr': {'$eq': ['$_id', '$$user_oid']}}}, {'$project': USER_CARD_PROJECTION}],
+            'as': 'owner'
+        }},
+        {'$unwind': '$owner'},
+        {'$lookup': {
+            'from': 'tracks',
+            'let': {
+                'album_id': {'$toString': '$_id'},
+                'visible': {'$and': [{'$ne': ['$enabled', False]}, {'$ne': ['$owner.enabled', False]}]},
+                'owner': {'id': {'$toString': '$owner._id'}, 'artistName': '$owner.artistName', 'username': '$owner.username'},
+                'album_summary': {'title': '$title', 'cover_image': {'$ifNull': ['$cover_image', None]}}
+            },
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$album_id', '$$album_id']}}},
+                {'$match': {'$expr': {'$or': [
+                    {'$ne': ['$visible', {'$and': ['$$visible', {'$ne': ['$enabled', False]}]}]},
+                    {'$ne': ['$owner', '$$owner']},
+                    {'$ne': [{'$ifNull': ['$album_summary.title', None]}, '$$album_summary.title']},
+                    {'$ne': [{'$ifNull': ['$album_summary.cover_image', None]}, '$$album_summary.cover_image']}
+                ]}}},
+                {'$limit': 1},
+                {'$project': {'_id': 1}}
+            ],
+            'as': 'stale'
+        }},
+        {'$match': {'stale.0': {'$exists': True}}},
+        {'$project': {'_id': 1}}
+    ]
+    return [album['_id'] for album in db.albums.aggregate(pipeline, allowDiskUse=True)]
+
+@app.cli.command("check-visibility")
+@click.option("--fix", is_flag=True, help="Recompute the tracks of the inconsistent albums.")
+def check_visibility_command(fix):
+    """Compare the denormalized visibility and summaries of tracks with their albums and owners."""
+    album_ids = stale_visibility_albums()
+    print(f"{len(album_ids)} albums with stale track fields")
+    for album_id in album_ids:
+        print(f"  {album_id}")
+    if fix and album_ids:
+        cascade_visibility({'_id': {'$in': album_ids}})
+        for album_id in album_ids:
+            catalog_changes.record('album', album_id)
+        print("Fixed")
+
+# Artist summaries
+
+class ArtistSummaries:
+    """Denormalized per-artist documents in `artist_stats`, keyed by user id.
+
+    Each holds the follower/following counts, total plays, latest releases,
+    albums the artist is featured on and their top track, pre-joined for the
+    artist page. They are kept up to date incrementally (follows, uploads,
+    play count flushes) and rebuilt from scratch only when missing or after
+    an album is enabled or disabled.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def get(self, user_id):
+        return db.artist_stats.find_one({'_id': user_id}) or self.rebuild(user_id)
+
+    def album_summary(self, album, track_ids, owner):
+        return {
+            'id': str(album['_id']),
+            'title': album['title'],
+            'cover_image': album.get('cover_image'),
+            'explicit': album.get('explicit', False),
+            'created_at': album.get('created_at'),
+            'tracks': track_ids,
+            'user': {'id': owner.id, 'artistName': owner.artistName, 'username': owner.username}
+        }
+
+    def track_summary(self, track, album):
+        return {
+            'id': str(track['_id']),
+            'title': track['title'],
+            'explicit': track.get('explicit', False),
+            'played': track.get('played', 0),
+            'album': {'id': str(album['_id']), 'title': album['title'], 'cover_image': album.get('cover_image'), 'user_id': album['user_id']}
+        }
+
+    def rebuild(self, user_id):
+        user_id = str(user_id)
+        users = EntityLoader(db.users, wrap=User)
+        owner = users.load(user_id)
+        if not owner:
+            return None
+
+        album_ids = [str(album_id) for album_id in db.albums.distinct('_id', {'user_id': user_id, 'enabled': True})]
+        latest = list(db.albums.find({'user_id': user_id, 'enabled': True}).sort('created_at', -1).limit(self.size))
+
+        featured_album_ids = [ObjectId(album_id) for album_id in db.tracks.distinct('album_id', {'featuring': user_id})]
+        featured = list(db.albums.find({'_id': {'$in': featured_album_ids}, 'enabled': True}).sort('created_at', -1).limit(self.size))
+        users.load_many(album['user_id'] for album in featured)
+
+        album_tracks = {}
+        for track in db.tracks.find({'album_id': {'$in': [str(album['_id']) for album in latest + featured]}}, {'album_id': 1}):
+            album_tracks.setdefault(track['album_id'], []).append(str(track['_id']))
+
+        top_track = db.tracks.find_one({'enabled': True, 'album_id': {'$in': album_ids}}, sort=[('played', -1)])
+        total_plays = next(db.tracks.aggregate([
+            {'$match': {'album_id': {'$in': album_ids}}},
+            {'$group': {'_id': None, 'played': {'$sum': '$played'}}}
+        ]), {'played': 0})['played']
+
+        summary = {
+            '_id': user_id,
+            'follower_count': db.follows.count_documents({'followed_id': user_id}),
+            'following_count': db.follows.count_documents({'follower_id': user_id}),
+            'total_plays': total_plays,
+            'latest_releases': [self.album_summary(album, album_tracks.get(str(album['_id']), []), owner) for album in latest],
+            'featured_on': [
+                self.album_summary(album, album_tracks.get(str(album['_id']), []), users.load(album['user_id']))
+                for album in featured if users.load(album['user_id'])
+            ],
+            'top_track': None
+        }
+        if top_track:
+            summary['top_track'] = self.track_summary(top_track, db.albums.find_one({'_id': ObjectId(top_track['album_id'])}))
+
+        db.artist_stats.replace_one({'_id': user_id}, summary, upsert=True)
+        return summary
+
+    def on_follow(self, follower_id, followed_id, amount):
+        # Summaries that don't exist yet will count follows when they are built
+        db.artist_stats.update_one({'_id': followed_id}, {'$inc': {'follower_count': amount}})
+        db.artist_stats.update_one({'_id': follower_id}, {'$inc': {'following_count': amount}})
+
+    def on_upload(self, album, owner, tracks):
+        track_ids = [str(track['_id']) for track in tracks]
+        summary = self.album_summary(album, track_ids, owner)
+        # Filtered on the album, so running this twice (a retried job) pushes it once
+        updates = [UpdateOne(
+            {'_id': owner.id, 'latest_releases.id': {'$ne': summary['id']}},
+            {'$push': {'latest_releases': {'$each': [summary], '$position': 0, '$slice': self.size}}}
+        )]
+        for user_id in {user_id for track in tracks for user_id in track.get('featuring', [])}:
+            updates.append(UpdateOne(
+                {'_id': user_id, 'featured_on.id': {'$ne': summary['id']}},
+                {'$push': {'featured_on': {'$each': [summary], '$position': 0, '$slice': self.size}}}
+            ))
+        db.artist_stats.bulk_write(updates, ordered=False)
+
+    def on_album_toggle(self, album):
+        user_ids = {album['user_id']}
+        user_ids.update(user_id for track in db.tracks.find({'album_id': str(album['_id'])}, {'featuring': 1}) for user_id in track.get('featuring', []))
+        for user_id in user_ids:
+            self.rebuild(user_id)
+
+    def on_plays(self, counts):
+        tracks = list(db.tracks.find({'_id': {'$in': list(counts)}}, {'title': 1, 'explicit': 1, 'played': 1, 'enabled': 1, 'album_id': 1}))
+        albums = EntityLoader(db.albums)
+        albums.load_many(track['album_id'] for track in tracks)
+
+        updates = []
+        for track in tracks:
+            album = albums.load(track['album_id'])
+            if not album:
+                continue
+            owner_id = album['user_id']
+            updates.append(UpdateOne({'_id': owner_id}, {'$inc': {'total_plays': counts[track['_id']]}}))
+            if track.get('enabled', True) and album.get('enabled', True):
+                # Replace the top track only if this one has now been played more
+                updates.append(UpdateOne(
+                    {'_id': owner_id, '$or': [{'top_track': None}, {'top_track.played': {'$lt': track.get('played', 0)}}]},
+                    {'$set': {'top_track': self.track_summary(track, album)}}
+                ))
+        if updates:
+            db.artist_stats.bulk_write(updates, ordered=True)
+
+artist_summaries = ArtistSummaries(app.config["ARTIST_SUMMARY_SIZE"])
+play_counter.listeners.append(artist_summaries.on_plays)
+
+# Following feed
+
+class Feeds:
+    """Per-user "new from artists you follow" timelines.
+
+    Every user has a `timelines` document with a capped list of
+    {album_id, user_id, created_at} items, newest first. Uploads are fanned
+    out to the timelines of the artist's followers when they are written,
+    except for artists with very large followings: their releases are pulled
+    at read time and merged in. Pages are cut with a (created_at, album_id)
+    cursor.
+    """
+    def __init__(self, size, fanout_limit, batch_size=1000):
+        self.size = size
+        self.fanout_limit = fanout_limit
+        self.batch_size = batch_size
+        self.large_artists = TTLCache(1, 60)
+
+    def item(self, album):
+        return {'album_id': str(album['_id']), 'user_id': album['user_id'], 'created_at': album['created_at']}
+
+    def push(self, user_ids, items):
+        update = {'$push': {'items': {'$each': items, '$sort': {'created_at': -1}, '$slice': self.size}}}
+        for start in range(0, len(user_ids), self.batch_size):
+            db.timelines.bulk_write(
+                [UpdateOne({'_id': user_id}, update, upsert=True) for user_id in user_ids[start:start + self.batch_size]],
+                ordered=False
+            )
+
+    def follower_count(self, user_id):
+        stats = db.artist_stats.find_one({'_id': user_id}, {'follower_count': 1})
+        if stats:
+            return stats['follower_count']
+        return db.follows.count_documents({'followed_id': user_id})
+
+    def is_large(self, user_id):
+        return self.follower_count(user_id) > self.fanout_limit
+
+    def get_large_artists(self):
+        """Ids of the artists whose releases are pulled instead of pushed."""
+        large_artists = self.large_artists.get('ids')
+        if large_artists is None:
+            large_artists = [stats['_id'] for stats in db.artist_stats.find({'follower_count': {'$gt': self.fanout_limit}}, {'_id': 1})]
+            self.large_artists.set('ids', large_artists)
+        return large_artists
+
+    def on_upload(self, album, owner):
+        if self.is_large(owner.id):
+            return
+        follower_ids = []
+        for follow in db.follows.find({'followed_id': owner.id}, {'follower_id': 1}):
+            follower_ids.append(follow['follower_id'])
+            if len(follower_ids) == self.batch_size:
+                self.push(follower_ids, [self.item(album)])
+                follower_ids = []
+        if follower_ids:
+            self.push(follower_ids, [self.item(album)])
+
+    def on_follow(self, follower_id, followed_id):
+        # Backfill the timeline with the artist's recent releases
+        if self.is_large(followed_id):
+            return
+        albums = db.albums.find({'user_id': followed_id, 'enabled': True}).sort('created_at', -1).limit(self.size)
+        items = [self.item(album) for album in albums]
+        if items:
+            self.push([follower_id], items)
+
+    def on_unfollow(self, follower_id, followed_id):
+        db.timelines.update_one({'_id': follower_id}, {'$pull': {'items': {'user_id': followed_id}}})
+
+    def page(self, user_id, cursor=None, limit=20):
+        """Return (items, next cursor) for a user's feed, newest first."""
+        before = decode_cursor(cursor, datetime) if cursor else None
+
+        timeline = db.timelines.find_one({'_id': user_id}) or {'items': []}
+        items = timeline['items']
+
+        # Pull releases from followed artists that are not fanned out
+        large_artists = self.get_large_artists()
+        if large_artists:
+            followed = [follow['followed_id'] for follow in db.follows.find(
+                {'follower_id': user_id, 'followed_id': {'$in': large_artists}}, {'followed_id': 1}
+            )]
+            if followed:
+                query = {'user_id': {'$in': followed}, 'enabled': True}
+                if before:
+                    query['created_at'] = {'$lte': before[0]}
+                items = items + [self.item(album) for album in db.albums.find(query).sort('created_at', -1).limit(limit + 1)]
+
+        items = sorted({item['album_id']: item for item in items}.values(), key=lambda item: (item['created_at'], item['album_id']), reverse=True)
+        if before:
+            items = [item for item in items if (item['created_at'], item['album_id']) < before]
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            last = items[-1]
+            next_cursor = encode_cursor(last['created_at'], last['album_id'])
+        return items, next_cursor
+
+feeds = Feeds(app.config["FEED_TIMELINE_SIZE"], app.config["FEED_FANOUT_LIMIT"])
+
+# Covers
+
+cover_store = CoverStore(
+    os.path.join(app.root_path, 'static', 'uploads', 'covers'),
+    os.path.join(app.root_path, 'static', 'uploads', 'covers', 'derived')
+)
+
+def cover_url(cover_image, variant='tile'):
+    """URL of a cover (as stored in `album['cover_image']`) resized for `variant`."""
+    if not cover_image:
+        return ""
+    return url_for('cover', variant=variant, filename=os.path.basename(cover_image))
+
+app.jinja_env.globals['cover_url'] = cover_url
+
+@app.template_filter('duration')
+def format_duration(seconds):
+    """m:ss (h:mm:ss from an hour) for a track duration in seconds."""
+    minutes, seconds = divmod(int(round(seconds or 0)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+@app.route("/covers/<variant>/<filename>")
+def cover(variant: str, filename: str):
+    filename = secure_filename(filename)
+    if not cover_store.exists(filename):
+        abort(404)
+    derived = cover_store.get(filename, variant)
+    # Covers stored by digest get it as their ETag, older ones a stat-based one
+    match = BLOB_NAME_RE.match(filename)
+    if derived:
+        etag = f"{match.group(1)}-{variant}" if match else True
+        response = send_from_directory(cover_store.derived_dir, derived, max_age=31536000, etag=etag)
+    else:
+        # No Pillow or an unreadable image, the original will do
+        response = send_from_directory(cover_store.covers_dir, filename, max_age=31536000, etag=match.group(1) if match else True)
+    # Cover names are unique per content (or per upload before digests), so they never change
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    return response
+
+# Blob storage
+
+def remove_seek_index(path):
+    if os.path.exists(mp3.index_path(path)):
+        os.remove(mp3.index_path(path))
+
+track_blobs = BlobStore(
+    'tracks', os.path.join(app.root_path, 'static', 'uploads', 'tracks'), lambda: db.blobs,
+    chunk_size=app.config["UPLOAD_CHUNK_SIZE"], grace_period=app.config["BLOB_GC_GRACE_PERIOD"], on_delete=remove_seek_index
+)
+cover_blobs = BlobStore(
+    'covers', cover_store.covers_dir, lambda: db.blobs,
+    chunk_size=app.config["UPLOAD_CHUNK_SIZE"], grace_period=app.config["BLOB_GC_GRACE_PERIOD"],
+    on_delete=lambda path: cover_store.remove(os.path.basename(path))
+)
+
+def blob_references():
+    """Actual number of documents referencing each track and cover file."""
+    tracks = Counter(os.path.basename(track['file_path']) for track in db.tracks.find({'file_path': {'$exists': True}}, {'file_path': 1}))
+    covers = Counter(os.path.basename(album['cover_image']) for album in db.albums.find({'cover_image': {'$nin': [None, ""]}}, {'cover_image': 1}))
+    return tracks, covers
+
+@app.cli.command("gc-blobs")
+@click.option("--dry-run", is_flag=True, help="Only list what would be deleted.")
+def gc_blobs_command(dry_run):
+    """Delete track and cover files no document references anymore."""
+    for store in (track_blobs, cover_blobs):
+        deleted = store.collect(dry_run=dry_run)
+        print(f"{store.kind}: {'would delete' if dry_run else 'deleted'} {len(deleted)} files")
+        for name in deleted:
+            print(f"  {name}")
+
+@app.cli.command("verify-blobs")
+@click.option("--fix", is_flag=True, help="Correct the stored reference counts.")
+def verify_blobs_command(fix):
+    """Check stored files against their digest and their reference counts."""
+    for store, references in zip((track_blobs, cover_blobs), blob_references()):
+        report = store.verify(references, fix=fix)
+        print(f"{store.kind}: {len(report['corrupt'])} corrupt, {len(report['missing'])} missing, "
+              f"{len(report['miscounted'])} with a wrong reference count{' (fixed)' if fix else ''}")
+        for name in report['corrupt']:
+            print(f"  corrupt {name}")
+        for name in report['missing']:
+            print(f"  missing {name}")
+        for name, stored, actual in report['miscounted']:
+            print(f"  {name}: {stored} references stored, {actual} actual")
+
 # Uploads management
 
+stream_cache = TTLCache(app.config["STREAM_CACHE_SIZE"], app.config["STREAM_CACHE_TTL"])
+play_sessions = TTLCache(app.config["STREAM_CACHE_SIZE"] * 4, app.config["PLAY_SESSION_TTL"])
+# Any catalog change may change which tracks can be streamed
+catalog_changes.listeners.append(lambda changes: stream_cache.clear())
+
+def track_access(track):
+    return {'track_id': track['_id'], 'enabled': track.get('visible', False)}
+
+def resolve_stream(track_id, filename):
+    """Resolve a track and its filename to what is needed to authorize streaming it.
+
+    The result (or a miss, as False) is cached so that the range requests the
+    player makes while seeking don't go back to the database.
+    """
+    key = f"{track_id}/{filename}"
+    access = stream_cache.get(key)
+    if access is not None:
+        return access
+
+    track = get_track_by_id(track_id)
+    # Files are shared by identical uploads, the track has to be the one asked for
+    if track and os.path.basename(track.get('file_path', "")) == filename:
+        access = track_access(track)
+    else:
+        access = False
+
+    stream_cache.set(key, access)
+    return access
+
+def resolve_legacy_stream(filename):
+    """Like resolve_stream, for the "/tracks/<filename>" URLs of older players."""
+    access = stream_cache.get(filename)
+    if access is not None:
+        return access
+
+    tracks = catalog_replica.tracks_by_file_path("/uploads/tracks/" + filename)
+    if tracks is UNKNOWN:
+        tracks = list(db.tracks.find({'file_path': "/uploads/tracks/" + filename}))
+    # Identical uploads share the file, it streams if any of their tracks is visible
+    track = next((track for track in tracks if track.get('visible')), tracks[0] if tracks else None)
+    if track:
+        get_loaders().tracks.prime(track)
+    access = track_access(track) if track else False
+
+    stream_cache.set(filename, access)
+    return access
+
+def track_url(track):
+    return url_for('stream_track', track_id=str(track['_id']), filename=os.path.basename(track['file_path']))
+
+def play_session_key(track_id):
+    listener = session.get('_user_id') or f"{request.remote_addr}|{request.user_agent.string}"
+    return f"{listener}|{track_id}"
+
+@app.route("/tracks/<track_id>/<filename>")
+def stream_track(track_id: str, filename: str):
+    return send_track(resolve_stream(track_id, filename), filename)
+
 @app.route("/tracks/<filename>")
 def getupload(filename: str):
-    file_path = os.path.join(app.root_path, 'static', 'uploads', 'tracks')
-    if not os.path.exists(os.path.join(file_path, filename)):
-        abort(404)
+    return send_track(resolve_legacy_stream(filename), filename)
 
-    track = db.tracks.find_one({'file_path': "/uploads/tracks/" + filename})
-    if not track:
+def send_track(access, filename):
+    if not access:
         abort(404)
-        
-    album = get_album_by_id(track['album_id'])
-    if not album:
-        abort(404)
-        
-    user = get_user_by_id(album['user_id'])
-    if not user:
-        abort(404)
-        
-    if (not track.get('enabled', True) or not album.get('enabled', True)) and not current_user.is_admin:
+
+    # Plays are reported by the player (see play_started), audio requests can be
+    # prefetches or never reach us at all once the file is cached
+    if not access['enabled'] and not is_admin(current_user):
         abort(404)
-        
-    if (not track.get('enabled', True) or not album.get('enabled', True)) and current_user.is_admin:
-        return send_from_directory(file_path, filename)
 
-    # Update play count
-    db.tracks.update_one({'_id': track['_id']}, {'$inc': {'played': 1}})
-    return send_from_directory(file_path, filename)
+    # Werkzeug handles Range, If-Range and ETag validation for conditional responses
+    match = BLOB_NAME_RE.match(filename)
+    # Content-addressed: the bytes behind this URL never change. Werkzeug only
+    # drops its default no-cache when given a max_age
+    cacheable = bool(match) and access['enabled']
+    response = send_from_directory(
+        track_blobs.directory, filename, conditional=True,
+        etag=match.group(1) if match else True,
+        max_age=31536000 if cacheable else None
+    )
+    response.headers['Accept-Ranges'] = 'bytes'
+    if cacheable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+# Page cache
+
+def auth_class():
+    if not current_user.is_authenticated:
+        return "anonymous"
+    return "admin" if is_admin(current_user) else "user"
+
+if app.config["PAGE_CACHE_BACKEND"] == "sqlite":
+    os.makedirs(app.instance_path, exist_ok=True)
+    page_cache_backend = SqliteBackend(app.config["PAGE_CACHE_PATH"], app.config["PAGE_CACHE_SIZE"])
+else:
+    page_cache_backend = MemoryBackend(app.config["PAGE_CACHE_SIZE"])
+# Keyed by the catalog version this worker has applied too: a worker that hasn't
+# caught up with a change yet only stores pages other workers no longer read
+page_cache = PageCache(page_cache_backend, app.config["PAGE_CACHE_TTL"], auth_class, version=lambda: catalog_changes.version)
+
+# Icons
+
+class IconSprite:
+    """All the icons of static/svg/ bundled into a single SVG sprite.
+
+    Each file becomes a `<symbol>` named after it in camelCase
+    ("play_arrow_24dp.svg" -> "playArrow"). The sprite is built once at
+    startup, gzipped ahead of time and served under its content hash, so
+    browsers can cache it forever.
+    """
+    SVG_RE = re.compile(r'<svg\b([^>]*)>(.*)</svg>', re.S)
+    VIEWBOX_RE = re.compile(r'viewBox="([^"]*)"')
+
+    def __init__(self, directory):
+        symbols = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".svg"):
+                continue
+            with open(os.path.join(directory, filename), encoding="utf-8") as file:
+                match = self.SVG_RE.search(file.read())
+            if not match:
+                continue
+            viewbox = self.VIEWBOX_RE.search(match.group(1))
+            symbols.append('<symbol id="{}" viewBox="{}">{}</symbol>'.format(
+                self.icon_name(filename), viewbox.group(1) if viewbox else "0 0 24 24", match.group(2)
+            ))
 
+        self.body = ('<svg xmlns="http://www.w3.org/2000/svg">' + "".join(symbols) + '</svg>').encode()
+        self.gzipped = gzip.compress(self.body, 9)
+        self.digest = hashlib.sha256(self.body).hexdigest()[:16]
 
-# Webpage
+    @staticmethod
+    def icon_name(filename):
+        words = filename[:-len(".svg")].replace("_24dp", "").split("_")
+        return words[0] + "".join(word.capitalize() for word in words[1:])
 
-@app.route("/")
-def index():
-    # Fetch latest releases
-    if not is_admin(current_user):
-        latest_releases_query = {'enabled': True}
-    else:
-        latest_releases_query = {}
-        
-    latest_releases_data = list(db.albums.find(latest_releases_query).sort('created_at', -1).limit(4))
-    
-    latest_releases = []
-    for release in latest_releases_data:
-        user = get_user_by_id(release['user_id'])
-        if user and (user.enabled or is_admin(current_user)):
-            latest_releases.append((
-                release,
-                user,
-                release.get('enabled', True) and user.enabled
-            ))
+    def url(self):
+        return url_for('icon_sprite', digest=self.digest)
 
-    # Fetch most played tracks
-    if not is_admin(current_user):
-        most_played_query = {'played': {'$gt': 0}, 'enabled': True}
+    def icon(self, name, classes=""):
+        return Markup('<svg class="{}" width="24" height="24" aria-hidden="true"><use href="{}#{}"></use></svg>').format(
+            classes, self.url(), name
+        )
+
+sprite = IconSprite(os.path.join(app.root_path, 'static', 'svg'))
+app.jinja_env.globals['icon'] = sprite.icon
+
+@app.route("/sprite/<digest>.svg")
+def icon_sprite(digest: str):
+    if digest != sprite.digest:
+        return redirect(sprite.url(), code=301)
+
+    if request.accept_encodings['gzip']:
+        response = Response(sprite.gzipped, mimetype="image/svg+xml")
+        response.headers['Content-Encoding'] = 'gzip'
     else:
-        most_played_query = {'played': {'$gt': 0}}
-        
-    most_played_data = list(db.tracks.find(most_played_query).sort('played', -1).limit(4))
-    
-    most_played = []
-    for track in most_played_data:
-        album = get_album_by_id(track['album_id'])
-        if album:
-            user = get_user_by_id(album['user_id'])
-            if user and (user.enabled or is_admin(current_user)):
-                most_played.append((
-                    track,
-                    user,
-                    track.get('enabled', True) and album.get('enabled', True) and user.enabled
-                ))
+        response = Response(sprite.body, mimetype="image/svg+xml")
+    response.vary.add('Accept-Encoding')
+    response.set_etag(sprite.digest)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response.make_conditional(request)
+
+# Webpage
 
-    return render_template("index.html", latest_releases=latest_releases, most_played=most_played)
+@app.route("/")
+@page_cache.cached
+def index():
+    # Latest releases and most played tracks come precomputed
+    charts = homepage_charts.snapshot(admin=is_admin(current_user))
+    return render_template("index.html", latest_releases=charts['latest_releases'], most_played=charts['most_played'],
+                           trending=charts['trending'], genres=charts['genres'])
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
@@ -282,21 +1733,24 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route("/album/<album_id>", methods=["GET", "POST"])
+@page_cache.cached
 def album(album_id: str):
-    album_data = get_album_by_id(album_id)
-    if not album_data:
-        abort(404)
-        
     if request.method == "GET":
-        if album_data and (album_data.get('enabled', True) or current_user.is_admin):
-            user_data = get_user_by_id(album_data['user_id'])
+        album_data = hydrate_album(album_id)
+        if album_data and (album_data.get('enabled', True) or is_admin(current_user)):
+            user_data = album_data['user']
             if not user_data:
                 abort(404)
+            album_data = visible_tracks(album_data, admin=is_admin(current_user))
             return render_template("album.html", title=album_data['title'], album_data=album_data, user_data=user_data)
         else:
             abort(404)
 
-    if not current_user.is_admin:
+    album_data = get_album_by_id(album_id)
+    if not album_data:
+        abort(404)
+
+    if not is_admin(current_user):
         abort(405)
 
     # Toggle album enabled status
@@ -304,135 +1758,241 @@ def album(album_id: str):
         {'_id': ObjectId(album_id)},
         {'$set': {'enabled': not album_data.get('enabled', True)}}
     )
+    catalog_replica.refresh('albums', ObjectId(album_id))
+    job_queue.submit("cascade_visibility", {'album_id': album_id}, background=True)
+    artist_summaries.on_album_toggle(album_data)
+    catalog_changes.record('album', album_id)
     return redirect(url_for('album', _method="GET", album_id=album_id))
 
-@app.route('/upload', methods=['GET', 'POST'])
-@login_required
-def upload():
-    if request.method == 'GET':
-        return render_template("upload.html", player_unavilable=True)
-
-    track_count = int(request.form['track_count'])
-    if any([len(request.form[f"track_title_{i}"]) < 1 for i in range(track_count)]):
-        flash("There can't be a track without a name.")
-        return redirect(url_for('upload'))
-
-    user = current_user
+def parse_upload_form(form, files, user):
+    """Validate the whole upload form before anything is written.
+
+    Returns (album, tracks, cover, notices) where every track is a dict with
+    its document fields, its file and its credits, cover is the cover file
+    and its actual extension (or None) and notices are the changes made to
+    the form, to flash once the album is stored. Otherwise raises ValueError
+    with every problem found, to flash as a single message.
+    """
+    errors = []
+    notices = []
+    try:
+        track_count = int(form['track_count'])
+        release_date = datetime.strptime(form['release_date'], '%Y-%m-%d')
+    except (KeyError, ValueError):
+        # Nothing else can be checked without them
+        raise ValueError("The album information is incomplete.")
+
+    if track_count < 1:
+        raise ValueError("An album needs at least one track.")
+    if not form.get("album_title") or not form.get("language") or not form.get("primary_genre"):
+        errors.append("The album information is incomplete.")
+    if any([len(form.get(f"track_title_{i}", "")) < 1 for i in range(track_count)]):
+        errors.append("There can't be a track without a name.")
+    if any([not files.get(f"track_file_{i}") for i in range(track_count)]):
+        errors.append("Every track needs an audio file.")
+
+    cover = None
+    cover_image = files.get('cover_image')
+    if cover_image:
+        extension = detect_format(cover_image.stream.read(16))
+        cover_image.stream.seek(0)
+        if not extension:
+            errors.append("The cover image has to be a JPEG, PNG, WebP or GIF image.")
+        cover = (cover_image, extension)
+
+    # Resolve every featuring artist of the album with a single query
+    featuring_names = set()
+    for i in range(track_count):
+        if form.get(f'has_featuring_{i}'):
+            featuring_names.update(name for name in form.getlist(f'featuring_{i}[]') if name)
+    featuring_users = {}
+    if featuring_names:
+        for user_data in db.users.find({'artistName': {'$in': list(featuring_names)}}, {'password_hash': 0}):
+            featuring_users[user_data['artistName']] = User(user_data)
 
-    # Create album
     album = {
-        'title': request.form["album_title"],
+        '_id': ObjectId(),
+        'title': form.get("album_title"),
         'user_id': user.id,
-        'release_date': datetime.strptime(request.form['release_date'], '%Y-%m-%d'),
-        'record_label': request.form.get('record_label'),
-        'language': request.form['language'],
-        'primary_genre': request.form['primary_genre'],
-        'secondary_genre': request.form.get('secondary_genre'),
+        'release_date': release_date,
+        'record_label': form.get('record_label'),
+        'language': form.get('language'),
+        'primary_genre': form.get('primary_genre'),
+        'secondary_genre': form.get('secondary_genre'),
         'created_at': datetime.utcnow(),
-        'enabled': True
+        'enabled': True,
+        # Check if any track is explicit
+        'explicit': any(f"is_explicit_{i}" in form for i in range(track_count))
     }
 
-    # Handle cover image
-    cover_image = request.files['cover_image']
-    if cover_image:
-        filename = secure_filename(f"{user.artistName}_{album['title']}_{time.time_ns()}_cover.jpg")
-        cover_image.save(os.path.join(app.config['UPLOAD_FOLDER'], 'covers', filename))
-        album['cover_image'] = "/uploads/covers/" + filename
-
-    # Check if any track is explicit
-    for i in range(track_count):
-        try:
-            request.form[f"is_explicit_{i}"]
-            album['explicit'] = True
-            break
-        except:
-            pass
-    else:
-        album['explicit'] = False
-
-    # Insert album to database
-    album_id = db.albums.insert_one(album).inserted_id
-
-    # Process tracks
+    tracks = []
     for i in range(track_count):
         confirmed_featurings = []
-        if request.form.get(f'has_featuring_{i}'):
-            featurings = request.form.getlist(f'featuring_{i}[]')
-
-            for featuring in featurings:
-                featuring_user = get_user_by_artist_name(featuring)
+        if form.get(f'has_featuring_{i}'):
+            for featuring in form.getlist(f'featuring_{i}[]'):
+                featuring_user = featuring_users.get(featuring)
                 if featuring_user and featuring_user.id == user.id:
-                    flash(f"You tried to add yourself as a featuring, we skipped it.")
+                    notices.append("You tried to add yourself as a featuring, we skipped it.")
                 elif featuring_user and featuring_user.enabled:
                     confirmed_featurings.append(featuring_user.id)
                 else:
-                    flash(f"User with artist name '{featuring}' doesn't exist. Ask them to create an account in Fanmade.")
-                    return redirect(url_for('upload'))
-
-        is_explicit = False
-        try:
-            request.form[f"is_explicit_{i}"]
-            is_explicit = True
-        except:
-            pass
+                    errors.append(f"User with artist name '{featuring}' doesn't exist. Ask them to create an account in Fanmade.")
 
         track = {
-            'title': request.form[f'track_title_{i}'],
-            'album_id': str(album_id),
-            'version_type': request.form[f'version_type_{i}'],
-            'explicit': is_explicit,
+            '_id': ObjectId(),
+            'title': form.get(f'track_title_{i}', ""),
+            'album_id': str(album['_id']),
+            'version_type': form.get(f'version_type_{i}'),
+            'explicit': f"is_explicit_{i}" in form,
             'enabled': True,
             'played': 0,
             'featuring': confirmed_featurings
         }
-        
-        # Handle track file upload
-        track_file = request.files[f'track_file_{i}']
-        if track_file:
-            filename = secure_filename(f"{user.artistName}_{album['title']}_{track['title']}_{time.time_ns()}.mp3")
-            track_file.save(os.path.join(app.config['UPLOAD_FOLDER'], 'tracks', filename))
-            track['file_path'] = "/uploads/tracks/" + filename
-        
-        # Insert track to database
-        track_id = db.tracks.insert_one(track).inserted_id
 
         # Process credits
-        written_by = request.form.getlist(f"written_by_{i}[]")
-        produced_by = request.form.getlist(f"produced_by_{i}[]")
-        metadata_by = request.form.getlist(f"metadata_by_{i}[]")
+        written_by = form.getlist(f"written_by_{i}[]")
+        produced_by = form.getlist(f"produced_by_{i}[]")
+        metadata_by = form.getlist(f"metadata_by_{i}[]")
 
         if not written_by:
-            written_by = [current_user.artistName]
-            flash("You are required to insert a writer on the writer list. As it wasn't added, your artist name will be added.")
+            written_by = [user.artistName]
+            notices.append("You are required to insert a writer on the writer list. As it wasn't added, your artist name will be added.")
 
         credits = []
-        for writer in written_by:
-            credits.append({
-                'track_id': str(track_id),
-                'category': 2,  # Writer
-                'name': writer
-            })
-
-        for producer in produced_by:
-            credits.append({
-                'track_id': str(track_id),
-                'category': 3,  # Producer
-                'name': producer
-            })
-
-        for metadata in metadata_by:
-            credits.append({
-                'track_id': str(track_id),
-                'category': 4,  # Metadata
-                'name': metadata
-            })
-
-        if credits:
-            db.credits.insert_many(credits)
+        for category, names in ((2, written_by), (3, produced_by), (4, metadata_by)):  # Writer, Producer, Metadata
+            for name in names:
+                credits.append({
+                    'track_id': str(track['_id']),
+                    'category': category,
+                    'name': name
+                })
+
+        tracks.append({'document': track, 'file': files.get(f'track_file_{i}'), 'credits': credits})
+
+    if errors:
+        raise ValueError(" ".join(dict.fromkeys(errors)))
+    return album, tracks, cover, list(dict.fromkeys(notices))
+
+@app.route('/upload', methods=['GET', 'POST'])
+@login_required
+def upload():
+    if request.method == 'GET':
+        return render_template("upload.html", player_unavilable=True)
+
+    user = current_user
+    try:
+        album, tracks, cover, notices = parse_upload_form(request.form, request.files, user)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('upload'))
+
+    try:
+        # Handle cover image
+        if cover:
+            cover_image, extension = cover
+            filename, size, created = cover_blobs.put(cover_image.stream, extension)
+            album['cover_image'] = "/uploads/covers/" + filename
+
+        # Handle track file uploads, stored once per distinct content
+        for track in tracks:
+            document = track['document']
+            filename, size, created = track_blobs.put(track['file'].stream, "mp3")
+            document['file_path'] = "/uploads/tracks/" + filename
+            document['file_hash'] = filename.split(".", 1)[0]
+            document['file_size'] = size
+
+        # Insert the album, its tracks and its credits, one ordered batch per collection
+        album_tracks = [track['document'] for track in tracks]
+        for document in album_tracks:
+            document.update(track_summaries(album, user), visible=True)
+        album_credits = [credit for track in tracks for credit in track['credits']]
+        db.albums.insert_one(album)
+        db.tracks.insert_many(album_tracks, ordered=True)
+        if album_credits:
+            db.credits.insert_many(album_credits, ordered=True)
+        track_blobs.acquire(os.path.basename(document['file_path']) for document in album_tracks)
+        if album.get('cover_image'):
+            cover_blobs.acquire([os.path.basename(album['cover_image'])])
+    except Exception:
+        app.logger.exception("Error uploading album")
+        # Roll back whatever was written so no half-uploaded album is left. The
+        # stored files may already be shared, unreferenced ones are left to gc-blobs.
+        db.credits.delete_many({'track_id': {'$in': [str(track['document']['_id']) for track in tracks]}})
+        db.tracks.delete_many({'album_id': str(album['_id'])})
+        db.albums.delete_one({'_id': album['_id']})
+        flash("Something went wrong while uploading your album, please try again.")
+        return redirect(url_for('upload'))
 
+    catalog_replica.put('albums', album)
+    for track in album_tracks:
+        catalog_replica.put('tracks', track)
+    catalog_changes.record('album', album['_id'])
+
+    # The album is stored, the rest happens after the response (in background
+    # threads without a queue). Keys make submitting again harmless; a new
+    # upload of the same album gets new ids and is a new album, only its files
+    # are shared (see track_blobs)
+    for track in album_tracks:
+        job_queue.submit("process_track", {'track_id': str(track['_id'])}, key=f"process_track:{track['_id']}", background=True)
+    if album.get('cover_image'):
+        filename = os.path.basename(album['cover_image'])
+        job_queue.submit("resize_cover", {'filename': filename}, key=f"resize_cover:{filename}", background=True)
+    job_queue.submit("publish_album", {'album_id': str(album['_id'])}, key=f"publish_album:{album['_id']}", background=True)
+
+    for notice in notices:
+        flash(notice)
     flash('Album uploaded successfully!')
     return redirect(url_for('index'))
 
+# Upload post-processing jobs
+
+@job_queue.handler("process_track")
+def process_track(payload):
+    """Read the duration and bitrate of an uploaded track and write its seek index."""
+    track = db.tracks.find_one({'_id': ObjectId(payload['track_id'])}, {'file_path': 1, 'file_hash': 1})
+    if not track:
+        return
+    path = track_blobs.path(os.path.basename(track['file_path']))
+
+    # A file already stored was analyzed with the track that first uploaded it
+    metadata = db.tracks.find_one(
+        {'file_hash': track['file_hash'], 'duration': {'$exists': True}}, {'duration': 1, 'bitrate': 1, 'sample_rate': 1}
+    )
+    if not metadata or not os.path.exists(mp3.index_path(path)):
+        try:
+            metadata = mp3.process(path)
+        except mp3.MP3Error as e:
+            # Not retried, the file won't get any better
+            app.logger.warning("Could not read audio metadata of %s: %s", path, e)
+            return
+
+    db.tracks.update_one({'_id': track['_id']}, {'$set': {
+        'duration': metadata['duration'],
+        'bitrate': metadata.get('bitrate'),
+        'sample_rate': metadata.get('sample_rate')
+    }})
+
+@job_queue.handler("resize_cover")
+def resize_cover(payload):
+    # Otherwise the variants are made on their first request
+    try:
+        cover_store.generate(payload['filename'])
+    except IMAGE_ERRORS as e:
+        app.logger.warning("Could not resize cover %s: %s", payload['filename'], e)
+
+@job_queue.handler("publish_album")
+def publish_album(payload):
+    """Add a new album to its artists' summaries and its followers' feeds."""
+    album = db.albums.find_one({'_id': ObjectId(payload['album_id'])})
+    owner = album and get_user_by_id(album['user_id'])
+    if not owner:
+        return
+    tracks = list(db.tracks.find({'album_id': payload['album_id']}, {'featuring': 1}))
+    artist_summaries.on_upload(album, owner, tracks)
+    feeds.on_upload(album, owner)
+    # Artist pages and hydrated albums rendered before this are outdated
+    catalog_changes.record('album', payload['album_id'])
+
 @app.route("/new_upload")
 def new_upload():
     if not (current_user.is_authenticated and current_user.is_admin):
@@ -440,7 +2000,8 @@ def new_upload():
 
     return render_template("new_upload.html", today=datetime.now().strftime("%Y-%m-%d"))
 
-@app.route("/artist/<username>")
+@app.route("/artist/<username>", methods=["GET", "POST"])
+@page_cache.cached
 def artist(username: str):
     if not username.startswith("@"):
         abort(400)
@@ -448,33 +2009,86 @@ def artist(username: str):
         username = username.replace("@", "").lower()
         user_data = get_user_by_username(username)
 
-    if not user_data or not user_data.enabled:
+    if not user_data or (not user_data.enabled and not is_admin(current_user)):
         abort(404)
+
+    if request.method == "POST":
+        if not is_admin(current_user):
+            abort(405)
+
+        # Toggle user enabled status
+        user_data.user_data['enabled'] = not user_data.enabled
+        user_data.save()
+        job_queue.submit("cascade_visibility", {'user_id': user_data.id}, background=True)
+        catalog_changes.record('user', user_data.id)
+        return redirect(url_for('artist', username="@" + user_data.username))
     
-    # Get latest releases
-    latest_releases = list(db.albums.find({'user_id': user_data.id, 'enabled': True}).sort('created_at', -1).limit(4))
-    
-    # Get featuring albums
-    # This is a bit tricky without SQL joins, so we'll handle it differently
-    featuring_tracks = list(db.tracks.find({'featuring': user_data.id}))
-    featuring_album_ids = [track['album_id'] for track in featuring_tracks]
-    featurings = []
-    if featuring_album_ids:
-        featurings = list(db.albums.find({'_id': {'$in': [ObjectId(aid) for aid in featuring_album_ids]}, 'enabled': True}).sort('created_at', -1).limit(4))
-    
-    # Get most played track
-    most_played = db.tracks.find_one(
-        {'enabled': True, 'album_id': {'$in': [str(album['_id']) for album in latest_releases]}},
-        sort=[('played', -1)]
-    )
-    
+    # Releases, featurings, counters and top track are precomputed
+    stats = artist_summaries.get(user_data.id)
+    if not stats:
+        abort(404)
+
+    window_plays, trending = play_analytics.artist(user_data.id)
+
     # Check if current user follows the artist
     follows = False
     if not isinstance(current_user, AnonymousUserMixin):
         follows = bool(db.follows.find_one({'follower_id': current_user.id, 'followed_id': user_data.id}))
 
-    return render_template("artist.html", follows=follows, current_data=current_user, title=user_data.artistName, 
-                          latest_releases=latest_releases, featurings=featurings, user_data=user_data, most_played=most_played)
+    return render_template("artist.html", follows=follows, current_data=current_user, title=user_data.artistName, stats=stats,
+                          latest_releases=stats['latest_releases'], featurings=stats['featured_on'], user_data=user_data,
+                          most_played=stats['top_track'], window_plays=window_plays, trending=trending)
+
+def get_visible_artist(username):
+    """User of an "@username" path segment, 404 if missing or disabled (except for admins)."""
+    if not username.startswith("@"):
+        abort(400)
+    user_data = get_user_by_username(username[1:].lower())
+    if not user_data or (not user_data.enabled and not is_admin(current_user)):
+        abort(404)
+    return user_data
+
+@app.route("/artist/<username>/releases")
+@page_cache.cached
+def releases(username: str):
+    user_data = get_visible_artist(username)
+    query = {'user_id': user_data.id}
+    if not is_admin(current_user):
+        query['enabled'] = True
+    albums, next_cursor = keyset_page(db.albums, query, 'created_at', request.args.get('cursor'),
+                                      app.config["PAGE_SIZE"], ALBUM_CARD_PROJECTION)
+    album_tracks = album_track_ids(album['_id'] for album in albums)
+    releases = [dict(album, id=str(album['_id']), tracks=album_tracks.get(str(album['_id']), [])) for album in albums]
+    return render_template("releases.html", title=user_data.artistName, user_data=user_data, releases=releases, next_cursor=next_cursor)
+
+@app.route("/artist/<username>/followers")
+@page_cache.cached
+def followers(username: str):
+    user_data = get_visible_artist(username)
+    follows, next_cursor = user_data.get_followers(request.args.get('cursor'), app.config["PAGE_SIZE"])
+    users = EntityLoader(db.users, wrap=User, projection=USER_CARD_PROJECTION).load_many(follow['follower_id'] for follow in follows)
+    followers = [users[follow['follower_id']] for follow in follows
+                 if follow['follower_id'] in users and users[follow['follower_id']].enabled]
+    return render_template("followers.html", title=user_data.artistName, user_data=user_data, followers=followers, next_cursor=next_cursor)
+
+@app.route("/feed")
+@login_required
+def feed():
+    items, next_cursor = feeds.page(current_user.id, request.args.get('cursor'), app.config["FEED_PAGE_SIZE"])
+
+    loaders = get_loaders()
+    albums = loaders.albums.load_many(item['album_id'] for item in items)
+    users = loaders.users.load_many(item['user_id'] for item in items)
+    album_tracks = album_track_ids(albums)
+
+    releases = []
+    for item in items:
+        album = albums.get(item['album_id'])
+        user = users.get(item['user_id'])
+        if album and user and album.get('enabled', True) and user.enabled:
+            releases.append((dict(album, id=item['album_id'], tracks=album_tracks.get(item['album_id'], [])), user))
+
+    return render_template("feed.html", title="Feed", releases=releases, next_cursor=next_cursor)
 
 @app.route("/follow/<user_id>", methods=["POST"])
 def follow(user_id: str):
@@ -493,6 +2107,9 @@ def follow(user_id: str):
             'follower_id': current_user.id,
             'followed_id': user_id
         })
+        artist_summaries.on_follow(current_user.id, user_id, 1)
+        feeds.on_follow(current_user.id, user_id)
+        page_cache.invalidate()
 
     return redirect(url_for('artist', username="@" + user.username))
 
@@ -509,142 +2126,275 @@ def unfollow(user_id: str):
     if not db.follows.find_one({'follower_id': current_user.id, 'followed_id': user_id}):
         flash(f"You don't follow {user.artistName}.")
     else:
-        db.follows.delete_one({'follower_id': current_user.id, 'followed_id': user_id})
+        if db.follows.delete_one({'follower_id': current_user.id, 'followed_id': user_id}).deleted_count:
+            artist_summaries.on_follow(current_user.id, user_id, -1)
+            feeds.on_unfollow(current_user.id, user_id)
+        page_cache.invalidate()
 
     return redirect(url_for('artist', username="@" + user.username))
 
 @app.route('/search', methods=['GET'])
+@page_cache.cached
 def search():
     query = request.args.get('query')  # Get search query
-    results = []
-    
-    if query:
-        try:
-            # Search for albums by title
-            title_results = list(db.albums.find({'title': {'$regex': query, '$options': 'i'}}))
-            
-            # Search for artists by name or username
-            artist_ids = []
-            artists = list(db.users.find({
-                '$or': [
-                    {'artistName': {'$regex': query, '$options': 'i'}},
-                    {'username': {'$regex': query, '$options': 'i'}}
-                ]
-            }))
-            
-            for artist in artists:
-                artist_ids.append(str(artist['_id']))
-                
-            # Get albums by these artists
-            artist_albums = list(db.albums.find({'user_id': {'$in': artist_ids}}))
-            
-            # Combine results
-            results = title_results + artist_albums
-            
-            # Remove duplicates
-            seen_ids = set()
-            unique_results = []
-            for album in results:
-                if str(album['_id']) not in seen_ids:
-                    seen_ids.add(str(album['_id']))
-                    unique_results.append(album)
-                    
-            results = unique_results
-            
-        except Exception as e:
-            # You can log the error if needed
-            print(f"Error performing search: {e}")
-    else:
+    if not query:
         return redirect(url_for('index'))
-    
-    return render_template('search.html', query=query, results=results, title=f"\"{query}\"")
+
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, float) if cursor else None
+    limit = app.config["SEARCH_RESULTS_LIMIT"]
+
+    results = []
+    next_cursor = None
+    try:
+        # Albums matching the title, artist, username, tracks or credits
+        matches = catalog_search.search(query, admin=is_admin(current_user), after=after, limit=limit + 1)
+        if len(matches) > limit:
+            matches = matches[:limit]
+            next_cursor = encode_cursor(matches[-1][0], matches[-1][1])
+        for score, album_id, meta in matches:
+            meta['id'] = album_id
+            meta['album_name'] = meta['title']
+            results.append(meta)
+    except Exception:
+        app.logger.exception("Error performing search")
+
+    return render_template('search.html', query=query, results=results, next_cursor=next_cursor, title=f"\"{query}\"")
 
 # API
 @app.route("/api/v1/play/<track_id>")
 def play(track_id: str):
     track = get_track_by_id(track_id)
-    if not track or not track.get('enabled', True):
+    if not track or not (track.get('visible') or is_admin(current_user)):
         abort(404)
-    
-    album = get_album_by_id(track['album_id'])
-    if not album:
-        abort(404)
-        
-    user_data = get_user_by_id(album['user_id'])
-    if not user_data:
+
+    return jsonify(playback_metadata(track))
+
+@app.route("/api/v1/play/<track_id>/started", methods=["POST"])
+def play_started(track_id: str):
+    """Sent by the player when a track actually starts playing."""
+    track = get_track_by_id(track_id)
+    if not track or not track.get('visible'):
         abort(404)
-        
-    response = {
+
+    # Update play count, once per playback session
+    if play_sessions.add(play_session_key(str(track['_id'])), True):
+        play_counter.add(track['_id'])
+    return "", 204
+
+@app.route("/api/v1/play")
+def play_manifest():
+    """Playback metadata for a whole queue (`?ids=a,b,c`), in queue order.
+
+    Unavailable tracks are left out, so the player can skip them.
+    """
+    track_ids = [track_id for track_id in request.args.get('ids', '').split(',') if track_id]
+    if not track_ids or len(track_ids) > app.config["PLAY_MANIFEST_LIMIT"]:
+        abort(400)
+
+    tracks = get_loaders().tracks.load_many(track_ids)
+    admin = is_admin(current_user)
+
+    manifest = []
+    for track_id in track_ids:
+        track = tracks.get(track_id)
+        if track and (track.get('visible') or admin):
+            manifest.append(dict(playback_metadata(track), track_id=track_id))
+
+    return jsonify({"tracks": manifest})
+
+def playback_metadata(track):
+    return {
         "track_title": track['title'],
-        "track_url": "/tracks/" + track['file_path'].replace("/uploads/tracks/", ""),
-        "album_title": album['title'],
-        "artist_name": user_data.artistName,
-        "cover_image": url_for('static', filename=album['cover_image']),
-        "album_id": str(album['_id'])
+        "track_url": track_url(track),
+        "album_title": track['album_summary']['title'],
+        "artist_name": track['owner']['artistName'],
+        "cover_image": cover_url(track['album_summary'].get('cover_image'), 'thumb'),
+        "album_id": track['album_id'],
+        "duration": track.get('duration')
     }
-    return jsonify(response)
 
-@app.route("/api/v1/credits/<track_id>")
-def track_credits(track_id: str):
-    track_data = get_track_by_id(track_id)
-    if not track_data or not track_data.get('enabled', True):
+@app.route("/api/v1/seek/<track_id>")
+def seek(track_id: str):
+    """Map a time in seconds (`?t=`) to the byte range that starts playing there."""
+    track = get_track_by_id(track_id)
+    if not track or not track.get('visible') or not track.get('file_path'):
         abort(404)
 
-    album = get_album_by_id(track_data['album_id'])
-    if not album:
-        abort(404)
-        
-    user_data = get_user_by_id(album['user_id'])
-    if not user_data:
-        abort(404)
+    try:
+        seconds = float(request.args.get('t', 0))
+    except ValueError:
+        abort(400)
 
-    credits = []
+    path = os.path.join(app.root_path, 'static', track['file_path'].lstrip('/'))
+    try:
+        with mp3.SeekIndex(mp3.index_path(path)) as index:
+            offset = index.offset_for(seconds)
+    except (OSError, mp3.MP3Error):
+        abort(404)
 
-    # Get performers (main artist + featuring artists)
-    performers_category = db.credits_categories.find_one({'id': 1})
-    category_name = performers_category['name'] if performers_category else "Performed by"
-    
-    artists = [user_data.artistName]
-    for featuring_id in track_data.get('featuring', []):
-        featuring_user = get_user_by_id(featuring_id)
-        if featuring_user:
-            artists.append(featuring_user.artistName)
-
-    credits.append({
-        "name": category_name,
-        "artists": artists
+    return jsonify({
+        "offset": offset,
+        "range": f"bytes={offset}-"
     })
 
-    # Get other credits
-    track_credits = list(db.credits.find({'track_id': track_id}))
-    categories = list(db.credits_categories.find())
-    
-    categories_dict = {cat['id']: cat['name'] for cat in categories}
-    
-    for credit in track_credits:
-        category_name = categories_dict.get(credit['category'], f"Category {credit['category']}")
-        existing_credit = next((item for item in credits if item["name"] == category_name), None)
-        if existing_credit:
-            existing_credit["artists"].append(credit['name'])
-        else:
-            credits.append({
-                "name": category_name,
-                "artists": [credit['name']]
-            })
+credit_categories = {}
+
+def get_credit_categories():
+    """Credit categories never change at runtime, they are loaded once per process."""
+    if not credit_categories:
+        credit_categories.update({category['id']: category['name'] for category in db.credits_categories.find()})
+    return credit_categories
 
-    return jsonify(credits)
+credits_cache = TTLCache(app.config["CREDITS_CACHE_SIZE"], app.config["CREDITS_CACHE_TTL"])
+catalog_changes.listeners.append(lambda changes: credits_cache.clear())
+
+def load_credits(track_id):
+    """Resolve a track, its featuring artists and credits in one aggregation."""
+    try:
+        track_oid = ObjectId(track_id)
+    except:
+        return None
+
+    pipeline = [
+        {'$match': {'_id': track_oid}},
+        {'$addFields': {
+            'track_key': {'$toString': '$_id'},
+            'artist_oids': {'$map': {
+                'input': {'$ifNull': ['$featuring', []]},
+                'as': 'user_id',
+                'in': {'$toObjectId': '$$user_id'}
+            }}
+        }},
+        {'$lookup': {
+            'from': 'users',
+            'localField': 'artist_oids',
+            'foreignField': '_id',
+            'pipeline': [{'$project': {'artistName': 1}}],
+            'as': 'artists'
+        }},
+        {'$lookup': {
+            'from': 'credits',
+            'localField': 'track_key',
+            'foreignField': 'track_id',
+            'pipeline': [{'$project': {'category': 1, 'name': 1}}],
+            'as': 'credits'
+        }},
+        {'$project': {'visible': 1, 'owner': 1, 'featuring': 1, 'artists': 1, 'credits': 1}}
+    ]
+    return next(db.tracks.aggregate(pipeline), None)
+
+@app.route("/api/v1/credits/<track_id>")
+def track_credits(track_id: str):
+    cached = credits_cache.get(track_id)
+    if cached is None:
+        track_data = load_credits(track_id)
+        if not track_data or not track_data.get('visible'):
+            abort(404)
+
+        artist_names = {str(artist['_id']): artist['artistName'] for artist in track_data['artists']}
+        categories = get_credit_categories()
+
+        # Get performers (main artist + featuring artists)
+        credits = {categories.get(1, "Performed by"): [track_data['owner']['artistName']] + [
+            artist_names[featuring_id] for featuring_id in track_data.get('featuring', []) if featuring_id in artist_names
+        ]}
+
+        # Get other credits
+        for credit in track_data['credits']:
+            category_name = categories.get(credit['category'], f"Category {credit['category']}")
+            credits.setdefault(category_name, []).append(credit['name'])
+
+        body = [{"name": name, "artists": artists} for name, artists in credits.items()]
+        etag = hashlib.sha1(repr(body).encode()).hexdigest()
+        cached = (body, etag)
+        credits_cache.set(track_id, cached)
+
+    body, etag = cached
+    response = jsonify(body)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
 
 @app.route("/api/v1/album/<album_id>")
 def album_api(album_id: str):
-    album = get_album_by_id(album_id)
-    if not album:
+    album = hydrate_album(album_id)
+    if not album or not album['user'] or not (album.get('enabled', True) or is_admin(current_user)):
         abort(404)
-        
-    tracks = list(db.tracks.find({'album_id': str(album['_id'])}))
-    
+
+    album = visible_tracks(album, admin=is_admin(current_user))
+
+    # Tracks are paginated by id, in album order
+    tracks = album['tracks']
+    cursor = request.args.get('cursor')
+    if cursor:
+        tracks = [track for track in tracks if track['id'] > cursor]
+    limit = page_limit(app.config["PAGE_SIZE_MAX"])
+    next_cursor = tracks[limit - 1]['id'] if len(tracks) > limit else None
+    album = dict(album, tracks=tracks[:limit])
+
     return jsonify({
+        'id': album['id'],
         'title': album['title'],
-        'tracks': [str(track['_id']) for track in tracks]
+        'artist_name': album['user'].artistName,
+        'username': album['user'].username,
+        'cover_image': cover_url(album.get('cover_image'), 'hero') or None,
+        'release_date': album['release_date'].strftime('%Y-%m-%d') if album.get('release_date') else None,
+        'explicit': album.get('explicit', False),
+        'tracks': [track['id'] for track in album['tracks']],
+        'track_details': [
+            {
+                'id': track['id'],
+                'title': track['title'],
+                'explicit': track.get('explicit', False),
+                'duration': track.get('duration'),
+                'featuring': [{'artist_name': user.artistName, 'username': user.username} for user in track['featuring']]
+            }
+            for track in album['tracks']
+        ],
+        'next_cursor': next_cursor
+    })
+
+@app.route("/api/v1/artist/<username>/albums")
+def artist_albums_api(username: str):
+    user_data = get_visible_artist(username)
+    albums, next_cursor = keyset_page(db.albums, {'user_id': user_data.id, 'enabled': True}, 'created_at',
+                                      request.args.get('cursor'), page_limit(), ALBUM_CARD_PROJECTION)
+    return jsonify({
+        'albums': [
+            {
+                'id': str(album['_id']),
+                'title': album['title'],
+                'cover_image': cover_url(album.get('cover_image'), 'tile') or None,
+                'explicit': album.get('explicit', False),
+                'created_at': album['created_at'].isoformat() if album.get('created_at') else None
+            }
+            for album in albums
+        ],
+        'next_cursor': next_cursor
+    })
+
+@app.route("/api/v1/artist/<username>/tracks")
+def artist_tracks_api(username: str):
+    """The artist's tracks, most played first."""
+    user_data = get_visible_artist(username)
+    tracks, next_cursor = keyset_page(db.tracks, {'owner.id': user_data.id, 'visible': True}, 'played',
+                                      request.args.get('cursor'), page_limit(), dict(TRACK_ROW_PROJECTION, album_summary=1), kind=int)
+    return jsonify({
+        'tracks': [
+            {
+                'id': str(track['_id']),
+                'title': track['title'],
+                'album_id': track['album_id'],
+                'album_title': track['album_summary']['title'],
+                'explicit': track.get('explicit', False),
+                'duration': track.get('duration'),
+                'played': track.get('played', 0)
+            }
+            for track in tracks
+        ],
+        'next_cursor': next_cursor
     })
 
 # Health check
@@ -652,6 +2402,37 @@ def album_api(album_id: str):
 def health():
     return jsonify({"status": "ok"})
 
+# Metrics
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    request_stats.start()
+    metrics.ensure_started()
+
+@app.after_request
+def record_request_metrics(response):
+    request_stats.stop()
+    if 'request_started' not in g:
+        return response
+
+    endpoint = request.endpoint or "unknown"
+    route_latency.observe(time.perf_counter() - g.request_started, endpoint, request.method, response.status_code)
+    route_queries.observe(request_stats.queries, endpoint)
+    if request_stats.queries > app.config["N_PLUS_ONE_THRESHOLD"]:
+        n_plus_one.inc(endpoint)
+        app.logger.warning("%s issued %d MongoDB commands (%.1f ms)", request.path, request_stats.queries, request_stats.query_time * 1000)
+    if endpoint in ("stream_track", "getupload") and response.content_length:
+        streamed_bytes.inc(amount=response.content_length)
+    return response
+
+@app.route("/metrics")
+def metrics_endpoint():
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        abort(401)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # Initialize database
 def init_db():
     # Create credit categories if they don't exist
@@ -672,11 +2453,134 @@ def init_db():
     db.users.create_index("email", unique=True)
     db.albums.create_index("user_id")
     db.albums.create_index("created_at")
+    db.albums.create_index([("user_id", 1), ("enabled", 1), ("created_at", -1)])
     db.tracks.create_index("album_id")
     db.tracks.create_index("played")
+    db.tracks.create_index("featuring")
     db.credits.create_index("track_id")
     db.follows.create_index([("follower_id", 1), ("followed_id", 1)], unique=True)
+    db.follows.create_index("followed_id")
+
+# Compound indexes matching the keyset pagination sorts, equality fields first
+def add_keyset_indexes():
+    db.albums.create_index([("user_id", 1), ("enabled", 1), ("created_at", -1), ("_id", -1)])
+    db.tracks.create_index([("album_id", 1), ("played", -1), ("_id", -1)])
+    db.follows.create_index([("followed_id", 1), ("_id", -1)])
+    db.follows.create_index([("follower_id", 1), ("_id", -1)])
+
+def add_play_analytics_indexes():
+    # Expires whole buckets after the retention period, and serves the window scans
+    db.play_buckets.create_index("day", expireAfterSeconds=app.config["PLAY_ANALYTICS_RETENTION_DAYS"] * 86400)
+
+def add_blob_indexes():
+    db.tracks.create_index("file_hash")
+    db.blobs.create_index([("kind", 1), ("refs", 1), ("created_at", 1)])
+
+def backfill_track_visibility():
+    db.tracks.create_index([("owner.id", 1), ("visible", 1), ("played", -1), ("_id", -1)])
+    cascade_visibility({})
+
+def add_job_indexes():
+    db.jobs.create_index("key", unique=True, partialFilterExpression={'key': {'$exists': True}})
+    db.jobs.create_index([("status", 1), ("run_at", 1)])
+    db.jobs.create_index([("status", 1), ("locked_until", 1)])
+    # Finished jobs (and their idempotency keys) are kept for a week
+    db.jobs.create_index("finished_at", expireAfterSeconds=7 * 86400)
+
+# Migrations, applied in order by `flask migrate` at deploy time and recorded
+# in the `migrations` collection. Every step must be safe to run twice: a
+# crash between a step and its recording means it runs again.
+MIGRATIONS = [
+    (1, init_db),
+    (2, add_keyset_indexes),
+    (3, add_play_analytics_indexes),
+    (4, add_blob_indexes),
+    (5, backfill_track_visibility),
+    (6, add_job_indexes)
+]
+
+def schema_version():
+    version = db.migrations.find_one({'_id': 'version'})
+    return version['version'] if version else 0
+
+def migrate(lock_timeout=300):
+    """Apply pending migrations, holding a lock so concurrent deploys don't race.
+
+    Returns the versions applied.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    locked_until = lambda: datetime.utcfromtimestamp(time.time() + lock_timeout)
+    deadline = time.monotonic() + lock_timeout
+    while True:
+        now = datetime.utcnow()
+        try:
+            # Matches a free or expired lock; if another process holds it the upsert hits the _id
+            db.migrations.find_one_and_update(
+                {'_id': 'lock', '$or': [{'locked_until': None}, {'locked_until': {'$lt': now}}]},
+                {'$set': {'owner': owner, 'locked_until': locked_until()}},
+                upsert=True
+            )
+            break
+        except DuplicateKeyError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for the migrations lock")
+            time.sleep(1)
+
+    applied = []
+    try:
+        current = schema_version()
+        for version, migration in MIGRATIONS:
+            if version > current:
+                migration()
+                db.migrations.update_one({'_id': 'version'}, {'$set': {'version': version, 'applied_at': datetime.utcnow()}}, upsert=True)
+                applied.append(version)
+                # Each step may take up to lock_timeout, not the whole run
+                renewed = db.migrations.update_one({'_id': 'lock', 'owner': owner}, {'$set': {'locked_until': locked_until()}})
+                if not renewed.matched_count:
+                    raise RuntimeError(f"Lost the migrations lock after applying migration {version}")
+    finally:
+        db.migrations.update_one({'_id': 'lock', 'owner': owner}, {'$set': {'locked_until': None}})
+    return applied
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Apply pending database migrations."""
+    applied = migrate()
+    print(f"Applied migrations {applied}" if applied else "Database is up to date")
+
+@app.cli.command("work-jobs")
+@click.option("--processes", default=os.cpu_count() or 1, show_default=True, help="Worker processes to run.")
+@click.option("--poll-interval", default=1.0, show_default=True, help="Seconds to wait when the queue is empty.")
+def work_jobs_command(processes, poll_interval):
+    """Run queued background jobs (with JOB_QUEUE_MODE=queue)."""
+    job_queue.work(processes, poll_interval)
+
+@app.cli.command("inspect-jobs")
+@click.option("--retry", "retry", is_flag=True, help="Queue the failed jobs again.")
+def inspect_jobs_command(retry):
+    """Show the jobs per name and status, and the latest failures."""
+    for name, statuses in sorted(job_queue.stats().items()):
+        print(f"{name}: " + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+    for job in job_queue.failed():
+        error = (job.get('error') or "").strip().splitlines()
+        print(f"failed {job['_id']} {job['name']} {job['payload']} after {job['attempts']} attempts: {error[-1] if error else ''}")
+    if retry:
+        print(f"Queued {job_queue.retry()} failed jobs again")
+
+# Readiness: unlike /health this fails until MongoDB answers and the schema is migrated
+@app.route("/ready")
+def ready():
+    try:
+        db.command('ping')
+        version = schema_version()
+    except PyMongoError as e:
+        # Details stay in the log, this endpoint is public
+        app.logger.warning("Not ready: %s", e)
+        return jsonify({"status": "unavailable"}), 503
+    if version < MIGRATIONS[-1][0]:
+        return jsonify({"status": "migrations pending", "version": version}), 503
+    return jsonify({"status": "ready", "version": version})
 
 if __name__ == "__main__":
-    init_db()
+    migrate()
     app.run(debug=False, port=80)
\ No newline at end of file
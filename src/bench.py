@@ -0,0 +1,340 @@
+"""Load and latency benchmark for Fanmade.
+
+Seeds a synthetic, reproducible catalog into a local MongoDB and drives the
+hot endpoints through the Flask test client, reporting p50/p95/p99 latency,
+throughput and MongoDB commands per request.
+
+    python bench.py --tracks 10000 --requests 300
+    python bench.py --tracks 100000 --drop --save-baseline baseline.json
+    python bench.py --tracks 100000 --no-seed --compare baseline.json
+
+It needs a real mongod (`mongod --dbpath /tmp/bench`): mongomock implements
+neither the aggregations the app relies on nor the command events queries
+per request are counted with.
+
+The target database ("fanmade_bench" by default, never the app's own
+MONGODB_DATABASE) is seeded when empty, or dropped and reseeded with --drop,
+which refuses any database whose name doesn't contain "bench". --no-seed
+reuses it as is. The synthetic audio files go to a temporary directory.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+GENRES = ["pop", "rock", "hip-hop", "electronic", "jazz", "metal", "folk", "latin"]
+WORDS = ["night", "summer", "fire", "blue", "road", "heart", "city", "dream", "ghost", "gold",
+         "river", "storm", "velvet", "neon", "echo", "wild", "paper", "moon", "glass", "tide"]
+AUDIO_FILES = 16
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fanmade load benchmark")
+    # Not read from MONGODB_URI/MONGODB_DATABASE: a shell set up for the app would point at real data
+    parser.add_argument("--mongodb-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="fanmade_bench")
+    parser.add_argument("--drop", action="store_true", help="drop the database and seed it again (name must contain \"bench\")")
+    parser.add_argument("--tracks", type=int, default=10000, help="catalog size in tracks (10k-1M)")
+    parser.add_argument("--tracks-per-album", type=int, default=10)
+    parser.add_argument("--albums-per-artist", type=int, default=5)
+    parser.add_argument("--follows-per-user", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--no-seed", action="store_true", help="reuse an already seeded database")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--scenarios", help="comma separated subset of scenarios to run")
+    parser.add_argument("--no-page-cache", action="store_true", help="disable the anonymous page cache")
+    parser.add_argument("--catalog-replica", action="store_true", help="serve lookups from the in-process catalog replica")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--save-baseline", help="write the results as the baseline to compare against")
+    parser.add_argument("--compare", help="baseline JSON file to compare the results with")
+    args = parser.parse_args()
+    if args.drop and "bench" not in args.database:
+        parser.error(f"refusing to drop {args.database!r}, the name must contain \"bench\"")
+    return args
+
+def configure_environment(args):
+    # Has to happen before the app is imported, it reads its config at import time
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ["MONGODB_URI"] = args.mongodb_uri
+    os.environ["MONGODB_DATABASE"] = args.database
+    os.environ["PAGE_CACHE_BACKEND"] = "memory"
+    if args.no_page_cache:
+        os.environ["PAGE_CACHE_TTL"] = "0"
+    if args.catalog_replica:
+        os.environ["CATALOG_REPLICA"] = "1"
+
+def write_audio_files(directory):
+    """A pool of small CBR MP3 files (silent MPEG-1 layer III frames) the tracks point to."""
+    frame = b"\xff\xfb\x90\x00" + b"\x00" * 413
+    names = []
+    for i in range(AUDIO_FILES):
+        name = f"bench_{i}.mp3"
+        with open(os.path.join(directory, name), "wb") as file:
+            file.write(frame * 2000)
+        names.append(name)
+    return names
+
+def seed(db, args, audio_files):
+    from bson.objectid import ObjectId
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    album_count = max(1, args.tracks // args.tracks_per_album)
+    artist_count = max(1, album_count // args.albums_per_artist)
+    now = datetime.utcnow()
+    # Hashing is slow on purpose, every synthetic user shares the same password
+    password_hash = generate_password_hash("benchmark")
+
+    def title(words):
+        return " ".join(rng.choice(WORDS).capitalize() for _ in range(words))
+
+    def insert(collection, documents):
+        for start in range(0, len(documents), 10000):
+            collection.insert_many(documents[start:start + 10000], ordered=False)
+
+    users = [{
+        '_id': ObjectId(),
+        'artistName': f"{title(2)} {i}",
+        'username': f"artist{i}",
+        'email': f"artist{i}@example.com",
+        'password_hash': password_hash,
+        'enabled': rng.random() > 0.02,
+        'is_admin': False
+    } for i in range(artist_count)]
+    insert(db.users, users)
+
+    albums = []
+    for i in range(album_count):
+        created_at = now - timedelta(minutes=album_count - i)
+        albums.append({
+            '_id': ObjectId(),
+            'title': title(rng.randint(1, 3)),
+            'user_id': str(users[i % artist_count]['_id']),
+            'release_date': created_at,
+            'record_label': None,
+            'language': "en",
+            'primary_genre': rng.choice(GENRES),
+            'secondary_genre': None,
+            'created_at': created_at,
+            'enabled': rng.random() > 0.02,
+            'explicit': rng.random() > 0.8,
+            'cover_image': "/uploads/covers/bench.jpg"
+        })
+    insert(db.albums, albums)
+
+    tracks = []
+    credits = []
+    for i in range(args.tracks):
+        album = albums[i % album_count]
+        featuring = []
+        if rng.random() < 0.2:
+            featuring = [str(rng.choice(users)['_id'])]
+        track = {
+            '_id': ObjectId(),
+            'title': title(rng.randint(1, 4)),
+            'album_id': str(album['_id']),
+            'version_type': "normal",
+            'explicit': album['explicit'],
+            'enabled': True,
+            # Long-tailed play counts
+            'played': int(rng.paretovariate(1.2)) - 1,
+            'featuring': featuring,
+            'file_path': "/uploads/tracks/" + audio_files[i % len(audio_files)],
+            'duration': 52.24
+        }
+        tracks.append(track)
+        credits.append({'track_id': str(track['_id']), 'category': 2, 'name': title(2)})
+        credits.append({'track_id': str(track['_id']), 'category': 3, 'name': title(2)})
+    insert(db.tracks, tracks)
+    insert(db.credits, credits)
+
+    follows = set()
+    for user in users:
+        for followed in rng.sample(users, min(args.follows_per_user, artist_count)):
+            if followed is not user:
+                follows.add((str(user['_id']), str(followed['_id'])))
+    insert(db.follows, [{'follower_id': follower, 'followed_id': followed} for follower, followed in follows])
+
+    return {
+        'users': len(users),
+        'albums': len(albums),
+        'tracks': len(tracks),
+        'credits': len(credits),
+        'follows': len(follows)
+    }
+
+def build_scenarios(db, rng):
+    """Scenario name -> function returning (path, headers) for one request."""
+    users = [user['username'] for user in db.users.find({'enabled': True}, {'username': 1}).limit(1000)]
+    albums = [str(album['_id']) for album in db.albums.find({'enabled': True}, {'_id': 1}).limit(1000)]
+    tracks = list(db.tracks.find({'visible': True}, {'_id': 1, 'album_id': 1, 'file_path': 1}).limit(1000))
+    track_ids = [str(track['_id']) for track in tracks]
+    streams = [f"/tracks/{track['_id']}/{track['file_path'].rsplit('/', 1)[-1]}" for track in tracks]
+
+    def ranged():
+        start = rng.randrange(0, 800000)
+        return {'Range': f"bytes={start}-{start + 65535}"}
+
+    return {
+        'index': lambda: ("/", {}),
+        'artist': lambda: (f"/artist/@{rng.choice(users)}", {}),
+        'album': lambda: (f"/album/{rng.choice(albums)}", {}),
+        'search': lambda: (f"/search?query={rng.choice(WORDS)}", {}),
+        'api_play': lambda: (f"/api/v1/play/{rng.choice(track_ids)}", {}),
+        'api_play_manifest': lambda: ("/api/v1/play?ids=" + ",".join(rng.sample(track_ids, min(10, len(track_ids)))), {}),
+        'api_album': lambda: (f"/api/v1/album/{rng.choice(albums)}", {}),
+        'api_credits': lambda: (f"/api/v1/credits/{rng.choice(track_ids)}", {}),
+        'tracks': lambda: (rng.choice(streams), {}),
+        'tracks_range': lambda: (rng.choice(streams), ranged())
+    }
+
+def wait_for_replica(replica, tracks, timeout=300):
+    replica.ensure_started()
+    deadline = time.monotonic() + timeout
+    while replica.tables is None and not replica.disabled and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if replica.tables is None:
+        print("Catalog replica did not load, lookups go to MongoDB")
+        return
+    footprint = replica.footprint()
+    line = f"Catalog replica: {footprint / 1024 ** 2:.1f} MB"
+    if tracks:
+        line += f", {footprint / tracks * 100000 / 1024 ** 2:.1f} MB per 100k tracks"
+    print(line + (" (change stream)" if replica.streaming else " (polling)"))
+
+def wait_for_search_index(catalog_search, timeout=300):
+    # Searches go to MongoDB until the index is built in the background
+    catalog_search.ensure()
+    deadline = time.monotonic() + timeout
+    while catalog_search.index is None and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+def run_scenario(app, request_stats, make_request, count, concurrency):
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [count]
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                path, headers = make_request()
+            started = time.perf_counter()
+            response = client.get(path, headers=headers)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                queries.append(request_stats.queries)
+                if response.status_code >= 400:
+                    errors.append(response.status_code)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'queries_per_request': statistics.mean(queries) if queries else 0.0
+    }
+
+def print_results(results, baseline=None):
+    header = f"{'scenario':<20}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(f"{name:<20}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['throughput_rps']:>10.1f}{result['queries_per_request']:>9.1f}{result['errors']:>8}")
+        if baseline and name in baseline:
+            before = baseline[name]
+            deltas = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_per_request'):
+                if before[key]:
+                    deltas.append(f"{key} {(result[key] - before[key]) / before[key] * 100:+.1f}%")
+            print(f"{'':<20}vs baseline: " + ", ".join(deltas))
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    rng = random.Random(args.seed)
+
+    import app as fanmade
+    db = fanmade.db
+
+    # Streamed from a scratch directory, never the app's uploads
+    tracks_dir = tempfile.mkdtemp(prefix="fanmade_bench_")
+    fanmade.track_blobs.directory = tracks_dir
+    audio_files = write_audio_files(tracks_dir)
+    try:
+        if not args.no_seed:
+            if args.drop:
+                db.client.drop_database(args.database)
+            elif db.list_collection_names():
+                raise SystemExit(f"{args.database} is not empty, pass --drop to reseed it or --no-seed to reuse it")
+            started = time.perf_counter()
+            counts = seed(db, args, audio_files)
+            print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s")
+        fanmade.migrate()
+        wait_for_search_index(fanmade.catalog_search)
+        if args.catalog_replica:
+            wait_for_replica(fanmade.catalog_replica, counts['tracks'] if not args.no_seed else None)
+
+        scenarios = build_scenarios(db, rng)
+        if args.scenarios:
+            scenarios = {name: scenarios[name] for name in args.scenarios.split(",")}
+
+        results = {}
+        for name, make_request in scenarios.items():
+            # One warm-up request so lazily built indexes and caches are not measured
+            path, headers = make_request()
+            fanmade.app.test_client().get(path, headers=headers)
+            results[name] = run_scenario(fanmade.app, fanmade.request_stats, make_request, args.requests, args.concurrency)
+        fanmade.play_counter.flush()
+    finally:
+        shutil.rmtree(tracks_dir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+    print_results(results, baseline)
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'save_baseline', 'compare')},
+        'results': results
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                json.dump(report, file, indent=2)
+
+if __name__ == "__main__":
+    main()
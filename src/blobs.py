@@ -0,0 +1,160 @@
+import hashlib
+import os
+import re
+import time
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+# "<sha-256 hex digest>.<extension>"
+BLOB_NAME_RE = re.compile(r"^([0-9a-f]{64})\.([a-z0-9]+)$")
+
+class BlobStore:
+    """Uploaded files stored once, under the SHA-256 digest of their content.
+
+    Files are named "<digest>.<extension>" in `directory`, so two uploads of
+    the same bytes share one file and a name never changes content (it can
+    be cached forever). Every blob has a document in `blobs` counting the
+    documents that reference it. `collect()` deletes the blobs nobody
+    references anymore, once older than `grace_period` seconds so an upload
+    still being written is never collected.
+    """
+    def __init__(self, kind, directory, get_collection, chunk_size=1024 ** 2, grace_period=3600, on_delete=None):
+        self.kind = kind
+        self.directory = directory
+        self.get_collection = get_collection
+        self.chunk_size = chunk_size
+        self.grace_period = grace_period
+        # Called with the path of every deleted blob, to remove files derived from it
+        self.on_delete = on_delete
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def put(self, stream, extension):
+        """Stream a file into the store, hashing it on the way.
+
+        Returns (name, size, created): created is False when the content was
+        already stored, the new copy is then discarded.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        partial_path = os.path.join(self.directory, f".{os.getpid()}.{time.time_ns()}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(partial_path, "wb") as output:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    output.write(chunk)
+
+            name = f"{digest.hexdigest()}.{extension}"
+            # Before looking for an existing copy: refreshing created_at stops a
+            # concurrent collect() from deleting the blob we are about to reuse
+            self.get_collection().update_one(
+                {'_id': name},
+                {'$set': {'kind': self.kind, 'size': size, 'created_at': datetime.utcnow()}, '$setOnInsert': {'refs': 0}},
+                upsert=True
+            )
+            created = not os.path.exists(self.path(name))
+            if created:
+                os.replace(partial_path, self.path(name))
+            else:
+                os.remove(partial_path)
+        except:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        return name, size, created
+
+    def acquire(self, names, amount=1):
+        """Count one more reference to each of `names` (repeated names count several times)."""
+        counts = {}
+        for name in names:
+            counts[name] = counts.get(name, 0) + amount
+        if counts:
+            self.get_collection().bulk_write(
+                [UpdateOne({'_id': name}, {'$inc': {'refs': count}}) for name, count in counts.items()],
+                ordered=False
+            )
+
+    def release(self, names):
+        self.acquire(names, amount=-1)
+
+    def delete(self, name):
+        path = self.path(name)
+        if os.path.exists(path):
+            os.remove(path)
+        if self.on_delete:
+            self.on_delete(path)
+
+    def collect(self, dry_run=False):
+        """Delete unreferenced blobs and digest-named files without a document.
+
+        Returns the names deleted (or that would be, with `dry_run`).
+        """
+        collection = self.get_collection()
+        cutoff = datetime.utcfromtimestamp(time.time() - self.grace_period)
+        deleted = []
+        for blob in collection.find({'kind': self.kind, 'refs': {'$lte': 0}, 'created_at': {'$lt': cutoff}}):
+            deleted.append(blob['_id'])
+            if not dry_run:
+                # Only if still unreferenced, an upload may have just reused it
+                if collection.delete_one({'_id': blob['_id'], 'refs': {'$lte': 0}, 'created_at': blob['created_at']}).deleted_count:
+                    self.delete(blob['_id'])
+
+        if os.path.isdir(self.directory):
+            names = [name for name in os.listdir(self.directory) if BLOB_NAME_RE.match(name)]
+            known = {blob['_id'] for blob in collection.find({'_id': {'$in': names}}, {'_id': 1})}
+            for name in names:
+                if name not in known and os.path.getmtime(self.path(name)) < cutoff.timestamp():
+                    deleted.append(name)
+                    if not dry_run:
+                        self.delete(name)
+        return deleted
+
+    def verify(self, references, fix=False):
+        """Check the store against `references` (name -> actual reference count).
+
+        Reports blobs whose content doesn't match their digest, referenced
+        blobs that are missing, and stored reference counts that are wrong
+        (corrected with `fix`). Files named before the store existed are
+        left alone.
+        """
+        collection = self.get_collection()
+        report = {'corrupt': [], 'missing': [], 'miscounted': []}
+        stored = {blob['_id']: blob for blob in collection.find({'kind': self.kind})}
+
+        for name in set(stored) | {name for name in references if BLOB_NAME_RE.match(name)}:
+            path = self.path(name)
+            if not os.path.exists(path):
+                if references.get(name):
+                    report['missing'].append(name)
+                continue
+            if file_digest(path, self.chunk_size) != BLOB_NAME_RE.match(name).group(1):
+                report['corrupt'].append(name)
+
+            refs = stored[name]['refs'] if name in stored else None
+            if refs != references.get(name, 0):
+                report['miscounted'].append((name, refs, references.get(name, 0)))
+                if fix:
+                    collection.update_one(
+                        {'_id': name},
+                        {'$set': {'refs': references.get(name, 0), 'kind': self.kind, 'size': os.path.getsize(path)},
+                         '$setOnInsert': {'created_at': datetime.utcnow()}},
+                        upsert=True
+                    )
+        return report
+
+def file_digest(path, chunk_size=1024 ** 2):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
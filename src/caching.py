@@ -0,0 +1,207 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, session, make_response
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def add(self, key, value):
+        """Store `value` only if `key` is not cached yet. Returns whether it was stored."""
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and item[0] >= time.monotonic():
+                return False
+            self._set(key, value, None)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+class SqliteConnections(threading.local):
+    """Connections to a local SQLite file, one per thread and per process.
+
+    Connections can't cross forks, a worker forked with one opens its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.pid = None
+
+    def get(self):
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.pid = os.getpid()
+        return self.connection
+
+# Page cache backends. Both store (body, content type, etag) entries with a TTL
+# plus a "generation" counter: bumping it invalidates every entry at once.
+
+class MemoryBackend:
+    """Per-process LRU backend. Invalidations only reach the current worker."""
+    def __init__(self, maxsize=1024):
+        self.entries = TTLCache(maxsize, 0)
+        self.generation = 0
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, value, ttl)
+
+    def get_generation(self):
+        return self.generation
+
+    def bump_generation(self):
+        self.generation += 1
+        self.entries.clear()
+
+class SqliteBackend:
+    """Backend on a local SQLite file, shared by every worker on the host."""
+    def __init__(self, path, maxsize=10000):
+        self.path = path
+        self.maxsize = maxsize
+        self.connections = SqliteConnections(path)
+        self.writes = 0
+        # Reading the generation on every request is cheap but not free
+        self.generation_checked = 0
+        self.generation = 0
+        self.connect().executescript("""
+            CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, body BLOB, content_type TEXT, etag TEXT, expires REAL);
+            CREATE INDEX IF NOT EXISTS pages_expires ON pages (expires);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER);
+            INSERT OR IGNORE INTO meta (name, value) VALUES ('generation', 0);
+        """)
+
+    def connect(self):
+        return self.connections.get()
+
+    def get(self, key):
+        row = self.connect().execute(
+            "SELECT body, content_type, etag FROM pages WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return (bytes(row[0]), row[1], row[2]) if row else None
+
+    def set(self, key, entry, ttl):
+        # Plain columns, never pickles: anything that can write the file could
+        # otherwise run code in every worker
+        body, content_type, etag = entry
+        connection = self.connect()
+        connection.execute(
+            "INSERT OR REPLACE INTO pages (key, body, content_type, etag, expires) VALUES (?, ?, ?, ?, ?)",
+            (key, body, content_type, etag, time.time() + ttl)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            connection.execute("DELETE FROM pages WHERE expires <= ?", (time.time(),))
+            connection.execute(
+                "DELETE FROM pages WHERE key IN (SELECT key FROM pages ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,)
+            )
+
+    def get_generation(self):
+        if time.monotonic() - self.generation_checked > 0.5:
+            self.generation = self.connect().execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0]
+            self.generation_checked = time.monotonic()
+        return self.generation
+
+    def bump_generation(self):
+        connection = self.connect()
+        connection.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+        connection.execute("DELETE FROM pages")
+        self.generation_checked = 0
+
+class PageCache:
+    """Response cache for rendered pages.
+
+    Entries are keyed by path, query arguments, auth class, the backend's
+    generation and `version()` (if given, e.g. the version of the data the
+    pages are rendered from). Only the auth classes in `classes` are stored (by default
+    just anonymous visitors, whose pages are identical), but every response
+    of a cached view gets a strong ETag and `304 Not Modified` handling.
+    """
+    def __init__(self, backend, ttl, auth_class, classes=("anonymous",), version=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.auth_class = auth_class
+        self.classes = set(classes)
+        self.version = version
+
+    def invalidate(self):
+        self.backend.bump_generation()
+
+    def key(self, auth_class):
+        args = "&".join(f"{name}={value}" for name, value in sorted(request.args.items(multi=True)))
+        version = self.version() if self.version else ""
+        return f"{self.backend.get_generation()}.{version}|{auth_class}|{request.path}?{args}"
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Pending flashed messages are rendered into the page, never cache those
+            if request.method != "GET" or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            auth_class = self.auth_class()
+            key = self.key(auth_class) if auth_class in self.classes else None
+            entry = self.backend.get(key) if key else None
+
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.direct_passthrough:
+                    return response
+                body = response.get_data()
+                entry = (body, response.headers.get('Content-Type'), hashlib.sha1(body).hexdigest())
+                if key:
+                    self.backend.set(key, entry, self.ttl)
+            else:
+                response = make_response(entry[0])
+                response.headers['Content-Type'] = entry[1]
+
+            response.set_etag(entry[2])
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Cookie')
+            return response.make_conditional(request)
+        return wrapper
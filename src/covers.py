@@ -0,0 +1,115 @@
+import os
+import threading
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Raised by unreadable or hostile (decompression bomb) images
+IMAGE_ERRORS = (OSError, ValueError) + ((Image.DecompressionBombError,) if Image is not None else ())
+
+# Covers resized at the same time share one of these, by name
+LOCK_STRIPES = 64
+
+# Variant name -> largest side in pixels
+VARIANTS = {
+    'thumb': 96,
+    'tile': 340,
+    'hero': 1024,
+    'blur': 24
+}
+
+MAGIC_NUMBERS = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif")
+)
+
+def detect_format(header):
+    """Guess an image extension from its first bytes, None if unknown."""
+    for magic, extension in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return extension
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class CoverStore:
+    """Resized variants of album covers, generated once and kept on disk.
+
+    Derivatives are written to `derived_dir` as "<cover name>.<variant>.<ext>",
+    in WebP when Pillow supports it and JPEG otherwise. Without Pillow no
+    derivative can be made and callers fall back to the original file.
+    """
+    def __init__(self, covers_dir, derived_dir, quality=80):
+        self.covers_dir = covers_dir
+        self.derived_dir = derived_dir
+        self.quality = quality
+        self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        if Image is not None and features.check('webp'):
+            self.extension, self.format = "webp", "WEBP"
+        else:
+            self.extension, self.format = "jpg", "JPEG"
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def variant_name(self, filename, variant):
+        return f"{filename}.{variant}.{self.extension}"
+
+    def variant_path(self, filename, variant):
+        return os.path.join(self.derived_dir, self.variant_name(filename, variant))
+
+    def exists(self, filename):
+        return os.path.isfile(os.path.join(self.covers_dir, filename))
+
+    def lock_for(self, filename):
+        # A fixed set, requests for made-up names can't grow it
+        return self.locks[hash(filename) % len(self.locks)]
+
+    def generate(self, filename, variants=VARIANTS):
+        """Write every missing variant of a cover. Returns the paths written."""
+        if not self.available:
+            return []
+        if not self.exists(filename):
+            raise FileNotFoundError(filename)
+        os.makedirs(self.derived_dir, exist_ok=True)
+
+        written = []
+        with self.lock_for(filename):
+            missing = [variant for variant in variants if not os.path.exists(self.variant_path(filename, variant))]
+            if not missing:
+                return written
+            with Image.open(os.path.join(self.covers_dir, filename)) as original:
+                image = ImageOps.exif_transpose(original).convert("RGB")
+            # Largest first, so every smaller variant resizes an already smaller image
+            for variant in sorted(missing, key=lambda variant: VARIANTS[variant], reverse=True):
+                image.thumbnail((VARIANTS[variant], VARIANTS[variant]), Image.LANCZOS)
+                path = self.variant_path(filename, variant)
+                image.save(path + ".part", self.format, quality=self.quality)
+                os.replace(path + ".part", path)
+                written.append(path)
+        return written
+
+    def get(self, filename, variant):
+        """Name of the variant of a cover in `derived_dir`, generated on first use.
+
+        Returns None when the variant can't be produced.
+        """
+        if variant not in VARIANTS or not self.available:
+            return None
+        if not os.path.exists(self.variant_path(filename, variant)):
+            try:
+                self.generate(filename)
+            except IMAGE_ERRORS:
+                return None
+        return self.variant_name(filename, variant)
+
+    def remove(self, filename):
+        for variant in VARIANTS:
+            path = self.variant_path(filename, variant)
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,178 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+class JobQueue:
+    """Background jobs, run in the web worker or persisted to a MongoDB queue.
+
+    Handlers are registered by name with `handler()` and receive the job's
+    payload. In "inline" mode `submit()` runs them right away in the calling
+    process (in a thread with `background=True`), errors are only logged
+    since the caller already committed whatever the job follows up on, and
+    nothing retries them; in "queue" mode it stores
+    the job in the `jobs` collection for `work()` to run in separate
+    processes.
+
+    Queued jobs are claimed with a visibility timeout: a job whose worker
+    died is picked up again once `visibility_timeout` seconds have passed,
+    so handlers must be safe to run more than once. Failures are retried
+    with exponential backoff up to `max_attempts` times. Jobs submitted
+    with a `key` are only queued once per key while the job is kept, so
+    submitting the same work twice (e.g. from a retried step) is harmless.
+    """
+    def __init__(self, get_collection, mode="inline", visibility_timeout=300, max_attempts=5, retry_delay=10):
+        self.get_collection = get_collection
+        self.mode = mode
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.handlers = {}
+        self.stopping = threading.Event()
+
+    def handler(self, name):
+        def register(function):
+            self.handlers[name] = function
+            return function
+        return register
+
+    def submit(self, name, payload, key=None, background=False):
+        if name not in self.handlers:
+            raise KeyError(f"No handler for job {name}")
+        if self.mode == "queue":
+            return self.enqueue(name, payload, key)
+
+        if background:
+            threading.Thread(target=self.run_inline, args=(name, payload), name=f"job-{name}", daemon=True).start()
+        else:
+            self.run_inline(name, payload)
+
+    def run_inline(self, name, payload):
+        try:
+            self.handlers[name](payload)
+        except Exception:
+            logger.exception("Error running job %s", name)
+
+    def enqueue(self, name, payload, key=None, delay=0):
+        """Store a job, returns its id (the existing job's for a known key)."""
+        now = datetime.utcnow()
+        job = {
+            'name': name,
+            'payload': payload,
+            'status': 'queued',
+            'attempts': 0,
+            'created_at': now,
+            'run_at': now + timedelta(seconds=delay)
+        }
+        if key:
+            job['key'] = key
+        collection = self.get_collection()
+        try:
+            return collection.insert_one(job).inserted_id
+        except DuplicateKeyError:
+            return collection.find_one({'key': key}, {'_id': 1})['_id']
+
+    def claim(self, worker):
+        """Lock the next due job for `worker`, None if there is none."""
+        now = datetime.utcnow()
+        return self.get_collection().find_one_and_update(
+            {'name': {'$in': list(self.handlers)}, '$or': [
+                {'status': 'queued', 'run_at': {'$lte': now}},
+                # Claimed by a worker that didn't finish in time
+                {'status': 'running', 'locked_until': {'$lt': now}}
+            ]},
+            {
+                '$set': {'status': 'running', 'worker': worker, 'locked_until': now + timedelta(seconds=self.visibility_timeout)},
+                '$inc': {'attempts': 1}
+            },
+            sort=[('run_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def complete(self, job):
+        self.get_collection().update_one(
+            {'_id': job['_id'], 'worker': job['worker']},
+            {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}, '$unset': {'locked_until': "", 'error': ""}}
+        )
+
+    def fail(self, job, error):
+        update = {'error': error, 'failed_at': datetime.utcnow()}
+        if job['attempts'] >= self.max_attempts:
+            update['status'] = 'failed'
+        else:
+            update['status'] = 'queued'
+            update['run_at'] = datetime.utcnow() + timedelta(seconds=self.retry_delay * 2 ** (job['attempts'] - 1))
+        self.get_collection().update_one({'_id': job['_id'], 'worker': job['worker']}, {'$set': update, '$unset': {'locked_until': ""}})
+
+    def run_one(self, worker):
+        """Claim and run one job. Returns whether there was one."""
+        job = self.claim(worker)
+        if job is None:
+            return False
+        try:
+            self.handlers[job['name']](job['payload'])
+        except Exception:
+            logger.warning("Job %s %s failed (attempt %d)", job['name'], job['_id'], job['attempts'])
+            self.fail(job, traceback.format_exc())
+        else:
+            self.complete(job)
+        return True
+
+    def run_worker(self, poll_interval=1):
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        while not self.stopping.is_set():
+            try:
+                if not self.run_one(worker):
+                    self.stopping.wait(poll_interval)
+            except Exception as e:
+                # Lost the database, try again later
+                logger.warning("Error claiming a job: %s", e)
+                self.stopping.wait(poll_interval)
+
+    def work(self, processes=1, poll_interval=1):
+        """Run `processes` worker processes until interrupted."""
+        if processes <= 1:
+            self.run_worker(poll_interval)
+            return
+        # Forked, so the children inherit the registered handlers
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=self.run_worker, args=(poll_interval,), daemon=True) for _ in range(processes)]
+        for process in workers:
+            process.start()
+        try:
+            for process in workers:
+                process.join()
+        except KeyboardInterrupt:
+            for process in workers:
+                process.terminate()
+            for process in workers:
+                process.join()
+
+    def stats(self):
+        """{name: {status: count}} of the jobs kept in the queue."""
+        stats = {}
+        for group in self.get_collection().aggregate([{'$group': {'_id': {'name': '$name', 'status': '$status'}, 'count': {'$sum': 1}}}]):
+            stats.setdefault(group['_id']['name'], {})[group['_id']['status']] = group['count']
+        return stats
+
+    def failed(self, limit=20):
+        return list(self.get_collection().find({'status': 'failed'}).sort('failed_at', -1).limit(limit))
+
+    def retry(self, job_id=None):
+        """Queue failed jobs (all of them, or one) again. Returns how many."""
+        query = {'status': 'failed'}
+        if job_id is not None:
+            query['_id'] = job_id
+        return self.get_collection().update_many(
+            query, {'$set': {'status': 'queued', 'attempts': 0, 'run_at': datetime.utcnow()}}
+        ).modified_count
@@ -0,0 +1,276 @@
+import atexit
+import bisect
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from pymongo import monitoring
+
+from caching import SqliteConnections
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labels, labels)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {labels: [list(counts), total, count] for labels, (counts, total, count) in self.values.items()}
+
+    def render(self, values):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        label_names = self.labels + ("le",)
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(label_names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+class Registry:
+    """The metrics of the app, rendered for Prometheus.
+
+    Values are recorded in memory by each process. With a `store`, every
+    process also writes its totals there every `interval` seconds (and when
+    rendering), and `render()` sums those of all the processes, so a scrape
+    answered by any worker sees the whole host.
+    """
+    def __init__(self, store=None, interval=5):
+        self.metrics = []
+        self.store = store
+        self.interval = interval
+        self.process = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def ensure_started(self):
+        if self.store is None or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # Unique even if the pid is reused later
+            self.process = f"{socket.gethostname()}:{self.pid}:{time.time_ns()}"
+            # Whatever was recorded before a fork belongs to the parent
+            for metric in self.metrics:
+                with metric.lock:
+                    metric.values.clear()
+            threading.Thread(target=self.run, name="metrics", daemon=True).start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error writing metrics")
+
+    def flush(self):
+        if self.process:
+            self.store.write(self.process, {metric.name: metric.snapshot() for metric in self.metrics})
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        if self.store is None:
+            totals = {metric.name: metric.snapshot() for metric in self.metrics}
+        else:
+            self.ensure_started()
+            self.flush()
+            totals = {metric.name: {} for metric in self.metrics}
+            for name, labels, value in self.store.read():
+                values = totals.get(name)
+                if values is not None:
+                    values[labels] = merge_values(values[labels], value) if labels in values else value
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(totals[metric.name]))
+        return "\n".join(lines) + "\n"
+
+class SqliteStore:
+    """Per-process metric totals in a local SQLite file shared by every worker of the host.
+
+    Rows of processes that exited are folded into a single "retired" process
+    so counters never go back and the file doesn't grow with every restart.
+    Labels and values are stored as JSON.
+    """
+    RETIRED = "retired"
+
+    def __init__(self, path):
+        self.path = path
+        self.connections = SqliteConnections(path)
+        self.connect().executescript("""
+            CREATE TABLE IF NOT EXISTS series (process TEXT, metric TEXT, labels TEXT, value TEXT, PRIMARY KEY (process, metric, labels));
+        """)
+
+    def connect(self):
+        return self.connections.get()
+
+    def write(self, process, totals):
+        rows = [
+            (process, name, json.dumps(labels), json.dumps(value))
+            for name, values in totals.items() for labels, value in values.items()
+        ]
+        connection = self.connect()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany("INSERT OR REPLACE INTO series (process, metric, labels, value) VALUES (?, ?, ?, ?)", rows)
+
+    def read(self):
+        self.retire()
+        for name, labels, value in self.connect().execute("SELECT metric, labels, value FROM series"):
+            yield name, tuple(json.loads(labels)), json.loads(value)
+
+    def retire(self):
+        """Fold the rows of this host's exited processes into the retired totals."""
+        connection = self.connect()
+        hostname = socket.gethostname()
+        exited = []
+        for (process,) in connection.execute("SELECT DISTINCT process FROM series WHERE process != ?", (self.RETIRED,)):
+            host, pid, _ = process.rsplit(":", 2)
+            if host == hostname and not pid_alive(int(pid)):
+                exited.append(process)
+        if not exited:
+            return
+
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            for process in exited:
+                for name, labels, value in connection.execute(
+                    "SELECT metric, labels, value FROM series WHERE process = ?", (process,)
+                ).fetchall():
+                    value = json.loads(value)
+                    row = connection.execute(
+                        "SELECT value FROM series WHERE process = ? AND metric = ? AND labels = ?", (self.RETIRED, name, labels)
+                    ).fetchone()
+                    if row:
+                        value = merge_values(json.loads(row[0]), value)
+                    connection.execute(
+                        "INSERT OR REPLACE INTO series (process, metric, labels, value) VALUES (?, ?, ?, ?)",
+                        (self.RETIRED, name, labels, json.dumps(value))
+                    )
+                connection.execute("DELETE FROM series WHERE process = ?", (process,))
+
+def merge_values(value, other):
+    # Counter values are numbers, histogram series [bucket counts, sum, count]
+    if isinstance(value, list):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]]
+    return value + other
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class RequestStats(threading.local):
+    """Mongo commands issued by the request being served in this thread."""
+    def __init__(self):
+        self.active = False
+        self.queries = 0
+        self.query_time = 0.0
+
+    def start(self):
+        self.active = True
+        self.queries = 0
+        self.query_time = 0.0
+
+    def stop(self):
+        self.active = False
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Counts and times every command sent to MongoDB.
+
+    Pymongo publishes command events from the thread that runs the command, so
+    they are also attributed to the request being served by that thread.
+    """
+    def __init__(self, registry, request_stats):
+        self.request_stats = request_stats
+        self.commands = registry.histogram("fanmade_mongo_command_duration_seconds", "MongoDB command latency", ("command", "status"))
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, "ok")
+
+    def failed(self, event):
+        self.record(event, "error")
+
+    def record(self, event, status):
+        duration = event.duration_micros / 1e6
+        self.commands.observe(duration, event.command_name, status)
+        if self.request_stats.active:
+            self.request_stats.queries += 1
+            self.request_stats.query_time += duration
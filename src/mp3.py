@@ -0,0 +1,262 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+# Bitrates in kbps indexed by [version][layer][bitrate index]. MPEG 2 and 2.5
+# share their table.
+BITRATES = {
+    1: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320)
+    },
+    2: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)
+    }
+}
+
+SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000)
+}
+
+VERSIONS = {0: 2.5, 2: 2, 3: 1}
+LAYERS = {1: 3, 2: 2, 3: 1}
+
+# Seek index file: magic, format version, frames per entry, sample rate,
+# samples per frame, frame count, entry count, then one uint32 offset per entry.
+INDEX_HEADER = struct.Struct("<4sHHIIII")
+INDEX_MAGIC = b"FMSI"
+INDEX_VERSION = 1
+
+class MP3Error(Exception):
+    pass
+
+class FrameHeader:
+    __slots__ = ('version', 'layer', 'bitrate', 'sample_rate', 'padding', 'channels', 'samples', 'length')
+
+    def __init__(self, version, layer, bitrate, sample_rate, padding, channels):
+        self.version = version
+        self.layer = layer
+        self.bitrate = bitrate
+        self.sample_rate = sample_rate
+        self.padding = padding
+        self.channels = channels
+        if layer == 1:
+            self.samples = 384
+            self.length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+        else:
+            self.samples = 1152 if layer == 2 or version == 1 else 576
+            self.length = self.samples // 8 * bitrate * 1000 // sample_rate + padding
+
+def parse_header(data, offset):
+    """Parse the 4-byte frame header at `offset`, or return None if there is no valid one."""
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[offset], data[offset + 1], data[offset + 2], data[offset + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = VERSIONS.get((b1 >> 3) & 0x03)
+    layer = LAYERS.get((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrate = BITRATES[1 if version == 1 else 2][layer][bitrate_index]
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    channels = 1 if (b3 >> 6) == 3 else 2
+    return FrameHeader(version, layer, bitrate, sample_rate, (b2 >> 1) & 0x01, channels)
+
+def skip_id3v2(data):
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+def find_frame(data, offset, allow_last=False):
+    """Offset and header of the first frame at or after `offset`, or (None, None).
+
+    Two consecutive valid headers are required so stray 0xFF bytes (in tags or
+    garbage) are not taken for a sync; with `allow_last` a frame reaching the
+    end of the data is enough, for files holding a single frame.
+    """
+    while True:
+        offset = data.find(b"\xff", offset)
+        if offset < 0:
+            return None, None
+        header = parse_header(data, offset)
+        if header and header.length > 4:
+            following = offset + header.length
+            if (allow_last and following >= len(data)) or parse_header(data, following):
+                return offset, header
+        offset += 1
+
+def find_first_frame(data, offset):
+    offset, header = find_frame(data, offset, allow_last=True)
+    if offset is None:
+        raise MP3Error("No MPEG audio frame found")
+    return offset, header
+
+def read_vbr_header(data, offset, header):
+    """Look for a Xing/Info or VBRI header in the frame at `offset`.
+
+    Returns None without one, else (tag, frames) where tag is b"Xing", b"Info"
+    (written by encoders for constant bitrate files) or b"VBRI" and frames is
+    the announced frame count, None if the header has none.
+    """
+    if header.version == 1:
+        side_info = 17 if header.channels == 1 else 32
+    else:
+        side_info = 9 if header.channels == 1 else 17
+
+    xing = offset + 4 + side_info
+    tag = data[xing:xing + 4]
+    if tag in (b"Xing", b"Info") and xing + 8 <= len(data):
+        flags = struct.unpack_from(">I", data, xing + 4)[0]
+        if flags & 0x01 and xing + 12 <= len(data):
+            return tag, struct.unpack_from(">I", data, xing + 8)[0]
+        return tag, None
+
+    vbri = offset + 36
+    if data[vbri:vbri + 4] == b"VBRI" and vbri + 18 <= len(data):
+        return b"VBRI", struct.unpack_from(">I", data, vbri + 14)[0]
+    return None
+
+class FrameIndexInfo:
+    __slots__ = ('step', 'sample_rate', 'samples', 'frames')
+
+    def __init__(self, step, sample_rate, samples, frames):
+        self.step = step
+        self.sample_rate = sample_rate
+        self.samples = samples
+        self.frames = frames
+
+def analyze(path, step=10):
+    """Parse the MP3 file at `path`.
+
+    Returns (metadata, offsets, info) where metadata holds the duration,
+    average bitrate, sample rate and channel count, offsets is an array with
+    the byte offset of every `step`-th audio frame and info describes how to
+    map a time to an entry of offsets.
+
+    The duration comes from the frame count announced by the encoder when
+    there is one (as players show it), else from the frames counted.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise MP3Error("Empty file")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset, first = find_first_frame(data, skip_id3v2(data))
+            vbr_header = read_vbr_header(data, offset, first)
+            announced_frames = None
+            if vbr_header is not None:
+                # The Xing/Info/VBRI frame carries no audio
+                offset += first.length
+                announced_frames = vbr_header[1] or None
+
+            offsets = array("I")
+            frames = 0
+            audio_bytes = 0
+            size = len(data)
+            while offset < size:
+                header = parse_header(data, offset)
+                if header is None or header.length <= 4:
+                    # Lost sync (trailing tags or garbage), look for the next frame
+                    offset, header = find_frame(data, offset + 1)
+                    if offset is None:
+                        break
+                    continue
+                if frames % step == 0:
+                    offsets.append(offset)
+                frames += 1
+                audio_bytes += header.length
+                offset += header.length
+
+    if not frames:
+        raise MP3Error("No MPEG audio frame found")
+
+    # The bitrate is that of the audio found, whatever the announced length
+    parsed_duration = frames * first.samples / first.sample_rate
+    total_frames = announced_frames or frames
+    duration = total_frames * first.samples / first.sample_rate
+    metadata = {
+        'duration': round(duration, 3),
+        'bitrate': round(audio_bytes * 8 / parsed_duration / 1000),
+        'sample_rate': first.sample_rate,
+        'channels': first.channels,
+        'frames': total_frames,
+        'vbr': vbr_header is not None and vbr_header[0] != b"Info"
+    }
+    return metadata, offsets, FrameIndexInfo(step, first.sample_rate, first.samples, frames)
+
+def write_seek_index(path, offsets, info):
+    partial_path = path + ".part"
+    with open(partial_path, "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, info.step, info.sample_rate,
+                                     info.samples, info.frames, len(offsets)))
+        if sys.byteorder != "little":
+            offsets = array("I", offsets)
+            offsets.byteswap()
+        offsets.tofile(file)
+    os.replace(partial_path, path)
+
+class SeekIndex:
+    """Memory-mapped reader for a seek index written by `write_seek_index()`."""
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.step, self.sample_rate, self.samples, self.frames, self.entries = \
+            INDEX_HEADER.unpack_from(self.data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.close()
+            raise MP3Error("Not a seek index")
+
+    def offset_for(self, seconds):
+        """Byte offset of the frame that plays at `seconds` (at most `step` frames early)."""
+        frame = int(max(seconds, 0) * self.sample_rate / self.samples)
+        entry = min(frame // self.step, self.entries - 1)
+        return struct.unpack_from("<I", self.data, INDEX_HEADER.size + 4 * entry)[0]
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def index_path(path):
+    return path + ".idx"
+
+def process(path, step=10):
+    """Analyze `path`, write its seek index next to it and return its metadata."""
+    metadata, offsets, info = analyze(path, step)
+    write_seek_index(index_path(path), offsets, info)
+    return metadata
+
+if __name__ == "__main__":
+    # Usage: python mp3.py FILE.mp3 [...]  (reports metadata and timings)
+    for path in sys.argv[1:]:
+        start = time.perf_counter()
+        metadata, offsets, info = analyze(path)
+        parsed = time.perf_counter()
+        write_seek_index(index_path(path), offsets, info)
+        written = time.perf_counter()
+        with SeekIndex(index_path(path)) as index:
+            lookups = 10000
+            for i in range(lookups):
+                index.offset_for(i % max(int(metadata['duration']), 1))
+        looked_up = time.perf_counter()
+        print(f"{path}: {metadata}")
+        print(f"  parse {parsed - start:.3f}s, write index ({len(offsets)} entries) {written - parsed:.3f}s, "
+              f"{(looked_up - written) / lookups * 1e6:.2f}us per seek lookup")
@@ -0,0 +1,137 @@
+import heapq
+import re
+import threading
+import unicodedata
+
+TOKEN_RE = re.compile(r"\w+")
+
+# How much a match on each field is worth. Exact token matches count double.
+FIELD_WEIGHTS = {
+    'title': 4.0,
+    'artist': 3.0,
+    'username': 3.0,
+    'track': 2.0,
+    'featuring': 1.5,
+    'credit': 1.0
+}
+
+def normalize(text):
+    """Case and accent fold `text`, so "Beyoncé" and "BEYONCE" index the same."""
+    decomposed = unicodedata.normalize('NFKD', text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+class SearchIndex:
+    """In-memory inverted index over albums.
+
+    Every token of every field is indexed under all its prefixes (edge n-grams),
+    so a query is answered by intersecting a few posting dicts instead of
+    scanning the catalog. Each document also carries free-form `meta` (title,
+    artist name, enabled flags...) so results can be rendered and filtered
+    without going back to the database.
+    """
+    def __init__(self, max_prefix=24):
+        self.max_prefix = max_prefix
+        self.prefixes = {}
+        self.exact = {}
+        self.documents = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, fields, **meta):
+        """Index `doc_id`. `fields` maps a field name to a list of strings."""
+        weights = {}
+        for field, values in fields.items():
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            for value in values:
+                for token in tokenize(value):
+                    if weights.get(token, 0) < weight:
+                        weights[token] = weight
+
+        with self.lock:
+            if doc_id in self.documents:
+                self.remove(doc_id)
+
+            for token, weight in weights.items():
+                self.exact.setdefault(token, {})[doc_id] = weight
+                for end in range(1, min(len(token), self.max_prefix) + 1):
+                    postings = self.prefixes.setdefault(token[:end], {})
+                    if postings.get(doc_id, 0) < weight:
+                        postings[doc_id] = weight
+
+            self.documents[doc_id] = {'tokens': weights, 'meta': meta}
+
+    def remove(self, doc_id):
+        with self.lock:
+            document = self.documents.pop(doc_id, None)
+            if not document:
+                return
+            for token in document['tokens']:
+                self._discard(self.exact, token, doc_id)
+                for end in range(1, min(len(token), self.max_prefix) + 1):
+                    self._discard(self.prefixes, token[:end], doc_id)
+
+    def _discard(self, index, key, doc_id):
+        postings = index.get(key)
+        if postings is not None:
+            postings.pop(doc_id, None)
+            if not postings:
+                del index[key]
+
+    def update_meta(self, doc_id, **meta):
+        with self.lock:
+            document = self.documents.get(doc_id)
+            if document:
+                document['meta'].update(meta)
+
+    def update_where(self, predicate, **meta):
+        """Update the meta of every document whose meta matches `predicate`."""
+        with self.lock:
+            for document in self.documents.values():
+                if predicate(document['meta']):
+                    document['meta'].update(meta)
+
+    def search(self, query, limit=50, predicate=None, after=None):
+        """Return up to `limit` (score, doc_id, meta) tuples ranked by score.
+
+        Every query token has to match (as a whole token or as a prefix).
+        `predicate` filters on meta. `after` is the (score, doc_id) of the last
+        result of the previous page, only results ranked below it are returned.
+        """
+        tokens = [token[:self.max_prefix] for token in dict.fromkeys(tokenize(query))]
+        if not tokens:
+            return []
+
+        with self.lock:
+            postings = [self.prefixes.get(token) for token in tokens]
+            if not all(postings):
+                return []
+
+            # Intersect starting from the rarest token
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for other in postings[1:]:
+                candidates.intersection_update(other)
+                if not candidates:
+                    return []
+
+            results = []
+            for doc_id in candidates:
+                meta = self.documents[doc_id]['meta']
+                if predicate and not predicate(meta):
+                    continue
+                score = 0.0
+                for token in tokens:
+                    exact = self.exact.get(token, {}).get(doc_id)
+                    score += exact * 2 if exact else self.prefixes[token][doc_id]
+                if after and (score, doc_id) >= after:
+                    continue
+                results.append((score, doc_id, meta))
+
+            # Best score first, ties broken by id (newest first for ObjectIds)
+            results = heapq.nlargest(limit, results, key=lambda result: (result[0], result[1]))
+            return [(score, doc_id, dict(meta)) for score, doc_id, meta in results]
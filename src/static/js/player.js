@@ -1,45 +1,95 @@
 document.addEventListener("DOMContentLoaded", function () {
+    const musicPlayer = document.getElementById("music-player");
     const trackTitle = document.getElementById("track-title");
     const trackArtist = document.getElementById("track-artist");
     const trackCover = document.getElementById("track-cover");
+    const trackDuration = document.getElementById("track-duration");
     const audioPlayer = document.getElementById("audio-player");
     const loopButton = document.getElementById("loop-button");
     const prevButton = document.getElementById("prev-button");
     const nextButton = document.getElementById("next-button");
-    let loopIcons;
+    const loopIcons = loopButton.querySelectorAll("svg");
 
     let loopState = 0;
 
     let currentTrackIndex = 0;
     //let currentAlbumId = null;
     let tracks = [];
+    // Playback metadata of the queue, by track id
+    let manifest = {};
+
+    // Seconds before the end of a track at which the next one starts loading
+    const PREFETCH_THRESHOLD = 20;
+    const prefetcher = new Audio();
+    prefetcher.preload = "auto";
+    prefetcher.muted = true;
+    let prefetchedTrackId = null;
+    // Track whose play hasn't been reported yet (audio requests don't count plays)
+    let unreportedTrackId = null;
+
+    // Known from the upload, before the audio starts loading
+    function formatDuration(seconds) {
+        seconds = Math.round(seconds);
+        const minutes = Math.floor(seconds / 60) % 60;
+        const hours = Math.floor(seconds / 3600);
+        const rest = String(seconds % 60).padStart(2, "0");
+        return hours ? `${hours}:${String(minutes).padStart(2, "0")}:${rest}` : `${minutes}:${rest}`;
+    }
 
     function updateLoopIcon() {
         loopIcons.forEach((icon, index) => {
-            console.log(icon, index)
             icon.classList.toggle("hidden", index !== loopState);
         });
     }
 
     function updateLoopState() {
-        console.log(loopState);
         loopState = (loopState + 1) % 3;
         updateLoopIcon();
     }
 
+    function nextTrackIndex() {
+        if (currentTrackIndex < tracks.length - 1) {
+            return currentTrackIndex + 1;
+        }
+        if (loopState === 1 && tracks.length > 0) {
+            return 0;
+        }
+        return null;
+    }
+
+    audioPlayer.addEventListener("playing", () => {
+        if (unreportedTrackId !== null) {
+            navigator.sendBeacon(`/api/v1/play/${unreportedTrackId}/started`);
+            unreportedTrackId = null;
+        }
+    });
+
     audioPlayer.addEventListener("ended", () => {
         if (loopState === 2) {
+            unreportedTrackId = tracks[currentTrackIndex];
             audioPlayer.currentTime = 0;
             audioPlayer.play();
-        } else if (loopState === 1 && currentTrackIndex === tracks.length - 1) {
-            currentTrackIndex = 0;
-            playTrack(tracks[currentTrackIndex]);
-        } else if (currentTrackIndex < tracks.length - 1) {
-            currentTrackIndex++;
+            return;
+        }
+        const next = nextTrackIndex();
+        if (next !== null) {
+            currentTrackIndex = next;
             playTrack(tracks[currentTrackIndex]);
         }
     });
 
+    audioPlayer.addEventListener("timeupdate", () => {
+        if (loopState === 2 || !audioPlayer.duration) {
+            return;
+        }
+        if (audioPlayer.duration - audioPlayer.currentTime < PREFETCH_THRESHOLD) {
+            const next = nextTrackIndex();
+            if (next !== null) {
+                prefetchTrack(tracks[next]);
+            }
+        }
+    });
+
     loopButton.addEventListener("click", updateLoopState);
 
     nextButton.addEventListener("click", () => {
@@ -56,14 +106,54 @@ document.addEventListener("DOMContentLoaded", function () {
         }
     });
 
-    function playTrack(trackId) {
-        fetch(`/api/v1/play/${trackId}`)
+    // Fetch the playback metadata of the whole queue in a single request
+    function loadManifest(trackIds) {
+        const missing = trackIds.filter(trackId => !manifest[trackId]);
+        if (missing.length === 0) {
+            return Promise.resolve();
+        }
+        return fetch(`/api/v1/play?ids=${missing.join(",")}`)
             .then(response => response.json())
+            .then(data => {
+                data.tracks.forEach(track => {
+                    manifest[track.track_id] = track;
+                });
+            });
+    }
+
+    function getTrackData(trackId) {
+        if (manifest[trackId]) {
+            return Promise.resolve(manifest[trackId]);
+        }
+        return fetch(`/api/v1/play/${trackId}`)
+            .then(response => response.json())
+            .then(data => {
+                manifest[trackId] = data;
+                return data;
+            });
+    }
+
+    // Start downloading the audio of the next track before the current one ends
+    function prefetchTrack(trackId) {
+        if (prefetchedTrackId === trackId || !manifest[trackId]) {
+            return;
+        }
+        prefetchedTrackId = trackId;
+        prefetcher.src = manifest[trackId].track_url;
+        prefetcher.load();
+    }
+
+    function playTrack(trackId) {
+        getTrackData(trackId)
             .then(data => {
                 trackTitle.textContent = data.track_title;
                 trackArtist.textContent = data.artist_name;
+                trackDuration.textContent = data.duration ? formatDuration(data.duration) : "";
                 trackCover.src = data.cover_image;
                 trackCover.classList.remove("hidden");
+                musicPlayer.classList.remove("hidden");
+                musicPlayer.classList.add("flex");
+                unreportedTrackId = trackId;
                 audioPlayer.src = data.track_url;
                 audioPlayer.play();
             })
@@ -72,25 +162,23 @@ document.addEventListener("DOMContentLoaded", function () {
 
     document.getElementById("close-player").addEventListener("click", () => {
         audioPlayer.pause();
-        musicPlayer.style.display = "none";
+        musicPlayer.classList.add("hidden");
+        musicPlayer.classList.remove("flex");
     });
 
-    document.querySelectorAll(".track-link").forEach(link => {
+    // Every track link on the page makes up the queue, in page order
+    const trackLinks = Array.from(document.querySelectorAll(".track-link"));
+    const queue = [...new Set(trackLinks.map(link => link.dataset.trackId))];
+
+    trackLinks.forEach(link => {
         link.addEventListener("click", event => {
             event.preventDefault();
             const trackId = link.dataset.trackId;
-            playTrack(trackId);
+            tracks = queue;
+            currentTrackIndex = tracks.indexOf(trackId);
+            loadManifest(tracks)
+                .catch(error => console.error("Error fetching queue data:", error))
+                .finally(() => playTrack(trackId));
         });
     });
-
-    const observer = new MutationObserver(() => {
-        const svgLoads = loopButton.querySelectorAll("svgload");
-        
-        if (svgLoads.length === 0) {
-            loopIcons = loopButton.querySelectorAll("svg")
-            observer.disconnect();
-        }
-    });
-
-    observer.observe(loopButton, { childList: true, subtree: true });
 });
@@ -0,0 +1,109 @@
+import struct
+
+import pytest
+
+import mp3
+
+# MPEG 1 layer III, 128 kbps, 44100 Hz, stereo, no CRC: 417 bytes per frame
+HEADER = b"\xff\xfb\x90\x00"
+FRAME_LENGTH = 417
+FRAME_SECONDS = 1152 / 44100
+
+def frame(payload=b""):
+    return HEADER + payload + bytes(FRAME_LENGTH - 4 - len(payload))
+
+def xing_frame(tag, frames=None):
+    # The tag follows the side information (32 bytes for stereo MPEG 1)
+    flags = 0x01 if frames is not None else 0
+    body = bytes(32) + tag + struct.pack(">I", flags)
+    if frames is not None:
+        body += struct.pack(">I", frames)
+    return frame(body)
+
+def vbri_frame(frames):
+    body = bytes(32) + b"VBRI" + struct.pack(">HHHII", 1, 0, 75, 0, frames)
+    return frame(body)
+
+def id3v2(size):
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x04\x00\x00" + syncsafe + bytes(size)
+
+@pytest.fixture
+def write(tmp_path):
+    def write(data):
+        path = tmp_path / "track.mp3"
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+def analyze(path):
+    metadata, offsets, info = mp3.analyze(path)
+    return metadata
+
+def test_counts_frames(write):
+    metadata = analyze(write(frame() * 1000))
+    assert metadata['frames'] == 1000
+    assert metadata['duration'] == round(1000 * FRAME_SECONDS, 3)
+    assert metadata['bitrate'] == 128
+    assert metadata['sample_rate'] == 44100
+    assert metadata['channels'] == 2
+    assert metadata['vbr'] is False
+
+def test_skips_id3v2_tag(write):
+    # A sync pattern inside the tag must not be taken for a frame
+    tag = id3v2(100)
+    tag = tag[:20] + HEADER + tag[24:]
+    assert analyze(write(tag + frame() * 10))['frames'] == 10
+
+def test_ignores_garbage_before_first_frame(write):
+    assert analyze(write(b"junk" + HEADER + b"junk" + frame() * 10))['frames'] == 10
+
+def test_ignores_trailing_tag_with_sync_bytes(write):
+    tail = b"TAG" + HEADER + bytes(121)
+    assert analyze(write(frame() * 1000 + tail))['frames'] == 1000
+
+def test_resyncs_after_garbage(write):
+    assert analyze(write(frame() * 5 + b"\x00\xff\x00" + HEADER + b"\x00" + frame() * 5))['frames'] == 10
+
+def test_single_frame(write):
+    assert analyze(write(frame()))['frames'] == 1
+
+def test_xing_header(write):
+    # The announced frame count wins over the frames found
+    metadata = analyze(write(xing_frame(b"Xing", 120) + frame() * 100))
+    assert metadata['frames'] == 120
+    assert metadata['duration'] == round(120 * FRAME_SECONDS, 3)
+    assert metadata['bitrate'] == 128
+    assert metadata['vbr'] is True
+
+def test_xing_header_without_frame_count(write):
+    metadata = analyze(write(xing_frame(b"Xing") + frame() * 100))
+    assert metadata['frames'] == 100
+    assert metadata['vbr'] is True
+
+def test_info_header_is_constant_bitrate(write):
+    metadata = analyze(write(xing_frame(b"Info", 100) + frame() * 100))
+    assert metadata['frames'] == 100
+    assert metadata['vbr'] is False
+
+def test_vbri_header(write):
+    metadata = analyze(write(vbri_frame(100) + frame() * 100))
+    assert metadata['frames'] == 100
+    assert metadata['vbr'] is True
+
+def test_rejects_empty_file(write):
+    with pytest.raises(mp3.MP3Error):
+        mp3.analyze(write(b""))
+
+def test_rejects_non_mpeg_data(write):
+    with pytest.raises(mp3.MP3Error):
+        mp3.analyze(write(b"\xff\x00" * 1000))
+
+def test_seek_index(write):
+    path = write(id3v2(100) + frame() * 100)
+    mp3.process(path, step=10)
+    with mp3.SeekIndex(mp3.index_path(path)) as index:
+        assert index.frames == 100
+        assert index.offset_for(0) == 110
+        assert index.offset_for(25 * FRAME_SECONDS) == 110 + 20 * FRAME_LENGTH
+        assert index.offset_for(3600) == 110 + 90 * FRAME_LENGTH